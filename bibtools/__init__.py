@@ -38,7 +38,7 @@ class BibApp(object):
         if self._thedb is None:
             from .db import connect
 
-            self._thedb = connect()
+            self._thedb = connect(self.cfg)
         return self._thedb
 
     @property
@@ -67,33 +67,26 @@ class BibApp(object):
 
     # Global-level helpers
 
-    def locate_pubs(self, textids, noneok=False, autolearn=False):
+    def resolve_pub_refs(self, textids, autolearn=False):
+        """Find the pubs matching each of `textids`. Returns a list of `(textid,
+        pubs)` in input order, where `pubs` is a list of PubRows, possibly
+        empty. The identifiers are grouped by kind so that each kind takes
+        just one query. If `autolearn` is true, the identifiers that don't
+        match anything are auto-learned together at the end."""
+
         from .bibcore import classify_pub_ref
 
+        refs = []
+        bykind = {}
+
         for textid in textids:
             kind, text = classify_pub_ref(textid)
-            q = matchtext = None
-
-            if kind == "doi":
-                q = self.db.pub_query("doi = ?", text)
-                matchtext = "DOI = " + text
-            elif kind == "bibcode":
-                q = self.db.pub_query("bibcode = ?", text)
-                matchtext = "bibcode = " + text
-            elif kind == "arxiv":
-                q = self.db.pub_query("arxiv = ?", text)
-                matchtext = "arxiv = " + text
-            elif kind == "nickname":
-                q = self.db.pub_fquery(
-                    "SELECT p.* FROM pubs AS p, nicknames AS n "
-                    "WHERE p.id == n.pubid AND n.nickname = ?",
-                    text,
-                )
-                matchtext = "nickname = " + text
-            elif kind == "lastlisting":
+            key = text
+
+            if kind == "lastlisting":
                 try:
-                    idx = int(text) - 1
-                    assert idx >= 0
+                    key = int(text) - 1
+                    assert key >= 0
                 except:
                     raise PubLocateError(
                         "pub names starting with %% should be "
@@ -101,40 +94,84 @@ class BibApp(object):
                         '"%s"',
                         text,
                     )
-                q = self.db.pub_fquery(
-                    "SELECT p.* FROM pubs AS p, publists AS l "
-                    "WHERE p.id == l.pubid AND l.name = ? AND "
-                    "l.idx = ?",
-                    "last_listing",
-                    idx,
-                )
-                matchtext = "lastlisting #" + text
-            elif kind == "nfasy":
-                nfas, year = text.rsplit(".", 1)
-                if year == "*":
-                    q = self.db.pub_query("nfas = ?", nfas)
-                else:
-                    q = self.db.pub_query("nfas = ? AND year = ?", nfas, year)
-                matchtext = "surname/year ~ " + text
-            else:
-                # This is a bug since we should handle every possible 'kind'
-                # returned by classify_pub_ref.
-                assert False
 
-            gotany = False
+            refs.append((textid, kind, key))
+            bykind.setdefault(kind, set()).add(key)
+
+        found = dict(
+            (kind, self.db.locate_pub_refs(kind, keys)) for kind, keys in bykind.items()
+        )
+        resolved = [(textid, found[kind].get(key, [])) for textid, kind, key in refs]
+
+        if autolearn:
+            leftovers = [textid for textid, pubs in resolved if not len(pubs)]
+
+            if len(leftovers):
+                learned = self._autolearn(leftovers)
+                resolved = [
+                    (textid, pubs if len(pubs) else [learned[textid]])
+                    for textid, pubs in resolved
+                ]
 
-            for pub in q:
-                gotany = True
+        return resolved
+
+    def locate_pubs(self, textids, noneok=False, autolearn=False):
+        resolved = self.resolve_pub_refs(textids, autolearn)
+
+        if not noneok:
+            for textid, pubs in resolved:
+                if not len(pubs):
+                    raise PubLocateError("no publications matched " + textid)
+
+        for textid, pubs in resolved:
+            for pub in pubs:
                 yield pub
 
-            if not gotany and autolearn:
-                from .bibcore import autolearn_pub
+    def _autolearn(self, texts):
+        """Auto-learn the pubs identified by `texts`, returning a dict mapping each
+        of them to its new PubRow. Texts that turn out to identify the same
+        pub, such as its DOI and its arXiv ID, share one new PubRow."""
 
-                yield self.db.learn_pub(autolearn_pub(self, textid))
+        from .bibcore import autolearn_pub
+
+        # Don't hold any locks while we go out to the network, and don't keep
+        # other processes from seeing what we've learned.
+        self.db.commit()
+        infos = {}  # text => info, for the texts that we'll actually learn
+        owners = {}  # text => the text whose info covers it
+        seen = {}  # (kind, identifier) => the text whose info has it
+
+        for text in texts:
+            if text in owners:
                 continue
 
-            if not gotany and not noneok:
-                raise PubLocateError("no publications matched " + textid)
+            info = autolearn_pub(self, text)
+            ids = [
+                (k, info[k])
+                for k in ("arxiv", "bibcode", "doi")
+                if info.get(k) is not None
+            ]
+            owner = next((seen[i] for i in ids if i in seen), None)
+
+            if owner is None:
+                owner = text
+                infos[text] = info
+            else:
+                # Fill in any identifiers that the first lookup didn't know.
+                for k, v in ids:
+                    if infos[owner].get(k) is None:
+                        infos[owner][k] = v
+
+            owners[text] = owner
+            for i in ids:
+                seen.setdefault(i, owner)
+
+        with self.db.write_transaction():
+            learned = dict(
+                (text, self.db.learn_pub(info)) for text, info in infos.items()
+            )
+
+        return dict((text, learned[owner]) for text, owner in owners.items())
 
     def locate_pub(self, text, noneok=False, autolearn=False):
         if autolearn:
@@ -153,33 +190,44 @@ class BibApp(object):
         if thepub is not None:
             return thepub
 
-        if autolearn:
-            from .bibcore import autolearn_pub
-
-            return self.db.learn_pub(autolearn_pub(self, text))
-
         # If we made it here, noneok must be true.
         return None
 
     def locate_or_die(self, text, autolearn=False):
-        try:
-            return self.locate_pub(text, autolearn=autolearn)
-        except MultiplePubsError as e:
-            import sys
+        return self.locate_each_or_die((text,), autolearn=autolearn)[0]
 
-            print("error:", e, file=sys.stderr)
-            print(file=sys.stderr)
-            from .bibcore import print_generic_listing
+    def locate_each_or_die(self, textids, autolearn=False):
+        """Like locate_or_die(), but for many identifiers at once. Returns a list
+        of one PubRow per identifier."""
 
-            print_generic_listing(
-                self.db, self.locate_pubs((text,), noneok=True), stream=sys.stderr
-            )
-            raise SystemExit(1)
-        except PubLocateError as e:
-            from .util import die
+        import sys
+        from .util import die
 
+        try:
+            resolved = self.resolve_pub_refs(textids, autolearn)
+        except PubLocateError as e:
             die(e)
 
+        result = []
+
+        for textid, pubs in resolved:
+            if len(pubs) > 1:
+                print(
+                    "error: more than one publication matched", textid, file=sys.stderr
+                )
+                print(file=sys.stderr)
+                from .bibcore import print_generic_listing
+
+                print_generic_listing(self.db, pubs, stream=sys.stderr)
+                raise SystemExit(1)
+
+            if not len(pubs):
+                die("no publications matched " + textid)
+
+            result.append(pubs[0])
+
+        return result
+
     def open_url(self, url):
         from .util import open_url
 
@@ -187,36 +235,83 @@ class BibApp(object):
 
     def try_get_pdf(self, pub):
         import os
-        from .util import bibpath, mkdir_p, ensure_libpath_exists, libpath
+        from .util import (
+            bibpath,
+            default_file_mode,
+            mkdir_p,
+            ensure_libpath_exists,
+            libpath,
+        )
         from .fetchpdf import try_fetch_pdf
 
+        import tempfile
+
         mkdir_p(bibpath("lib"))
-        temppath = bibpath("lib", "incoming.pdf")
 
-        sha1 = try_fetch_pdf(
-            self.proxy, temppath, arxiv=pub.arxiv, bibcode=pub.bibcode, doi=pub.doi
+        # Several bib processes may be downloading at once.
+        fd, temppath = tempfile.mkstemp(
+            prefix="incoming.", suffix=".pdf", dir=bibpath("lib")
         )
-        if sha1 is None:
-            return None
+        os.close(fd)
+
+        # No locks held while we're out on the network.
+        self.db.commit()
 
-        ensure_libpath_exists(sha1)
-        destpath = libpath(sha1, "pdf")
-        os.rename(temppath, destpath)
-        self.db.execute("INSERT OR REPLACE INTO pdfs VALUES (?, ?)", (sha1, pub.id))
+        try:
+            sha1 = try_fetch_pdf(
+                self.proxy, temppath, arxiv=pub.arxiv, bibcode=pub.bibcode, doi=pub.doi
+            )
+            if sha1 is None:
+                return None
+
+            # mkstemp() makes files that only we can read, but the library
+            # should get the usual permissions.
+            os.chmod(temppath, default_file_mode())
+
+            ensure_libpath_exists(sha1)
+            destpath = libpath(sha1, "pdf")
+            os.rename(temppath, destpath)
+        finally:
+            if os.path.exists(temppath):
+                os.unlink(temppath)
+
+        with self.db.write_transaction():
+            self.db.execute("INSERT OR REPLACE INTO pdfs VALUES (?, ?)", (sha1, pub.id))
         return sha1
 
+    def get_full_authors(self, pub, authtype="author"):
+        """Returns a list of `(given, family)` tuples. If only a truncated
+        author list is stored in the database, the full one is fetched from
+        the pub's source. It isn't saved, since the whole point of truncating
+        was to avoid that."""
+
+        from .bibcore import autolearn_pub, parse_names
+
+        if authtype not in self.db.get_pub_truncations(pub.id):
+            return self.db.get_pub_authors(pub.id, authtype)
+
+        ident = pub.bibcode or pub.doi or pub.arxiv
+        if ident is None:
+            from .util import die
+
+            die("cannot fetch the full author list: no identifiers to look it up with")
+
+        return parse_names(autolearn_pub(self, ident).get(authtype + "s") or [])
+
     def export_all(self, stream, width, **kwargs):
         from .textfmt import export_one
 
+        backup = kwargs.get("include_backup_data", False)
         first = True
 
-        for pub in self.db.pub_fquery("SELECT * FROM pubs ORDER BY nfas ASC, year ASC"):
-            if first:
-                first = False
-            else:
-                stream.write("\f\n")
+        for batch in self.db.pub_batches(self.db.pub_named_query("all"), backup=backup):
+            for pub in batch.pubs:
+                if first:
+                    first = False
+                else:
+                    stream.write("\f\n")
 
-            export_one(self, pub, stream, width, **kwargs)
+                export_one(self, pub, stream, width, batch=batch, **kwargs)
 
     def rsync_backup(self):
         import io, os.path, shutil, subprocess
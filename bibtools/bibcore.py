@@ -20,23 +20,40 @@ replace nonletters with periods, so it's a gmail-ish form.
 
 """
 
+import functools
 import re
 import sys
+from unicodedata import normalize
 
 from .util import *
 
 __all__ = (
-    "parse_name encode_name normalize_surname sniff_url "
+    "parse_name parse_names encode_name name_initials normalize_surname "
+    "normalize_surnames "
+    "sniff_url "
     "classify_pub_ref doi_to_maybe_bibcode autolearn_pub "
     "print_generic_listing parse_search"
 ).split()
 
 
 def parse_name(text):
-    parts = text.rsplit(" ", 1)
-    if len(parts) == 1:
-        return "", parts[0].replace("_", " ")
-    return parts[0], parts[1].replace("_", " ")
+    given, _, family = text.rpartition(" ")
+    return given, family.replace("_", " ")
+
+
+def parse_names(texts):
+    """Like parse_name(), but for a whole sequence of names at once, returning a
+    list of `(given, family)` tuples. Collaboration papers can have thousands
+    of authors, so this is worth streamlining."""
+
+    result = []
+    append = result.append
+
+    for text in texts:
+        given, _, family = text.rpartition(" ")
+        append((given, family.replace("_", " ")))
+
+    return result
 
 
 def encode_name(given, family):
@@ -45,13 +62,46 @@ def encode_name(given, family):
     return given + " " + family.replace(" ", "_")
 
 
+_nonletters_re = re.compile(r"[^a-z]+")
+_given_split_re = re.compile(r"[\s.\-]+")
+
+
+def name_initials(given):
+    """Returns the initials of the given names: "Peter K. G." => "PKG".
+    Hyphenated names give multiple initials, so that "Jean-Luc" => "JL"."""
+    return "".join(w[0] for w in _given_split_re.split(given) if len(w)).upper()
+
+
+@functools.lru_cache(maxsize=16384)
 def normalize_surname(name):
-    from unicodedata import normalize
+    name = str(name)
+
+    if not name.isascii():
+        # this strips accents:
+        name = normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
 
-    # this strips accents:
-    name = normalize("NFKD", str(name)).encode("ascii", "ignore").decode("ascii")
     # now strip non-letters and condense everything:
-    return re.sub(r"\.\.+", ".", re.sub(r"[^a-z]+", ".", name.lower()))
+    return _nonletters_re.sub(".", name.lower())
+
+
+def normalize_surnames(names):
+    """Like normalize_surname(), but for a whole sequence of names at once,
+    returning a list. This skips the cache, which doesn't help much when
+    loading the thousands of mostly distinct names of a collaboration paper."""
+
+    result = []
+    append = result.append
+    sub = _nonletters_re.sub
+
+    for name in names:
+        name = str(name)
+
+        if not name.isascii():
+            name = normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+
+        append(sub(".", name.lower()))
+
+    return result
 
 
 _arxiv_re_1 = re.compile(r"^\d\d[01]\d\.\d+")
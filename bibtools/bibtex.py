@@ -9,7 +9,12 @@ TODO: styles defined in a support file or something.
 
 """
 
+import json
+import re
+
 from .bibcore import *
+from .issnmap import get_issn_map
+from .normalize import default_normalizers, normalize_refdata
 from .unicode_to_latex import unicode_to_latex
 from .util import *
 from . import webutil as wu
@@ -17,9 +22,13 @@ from . import webutil as wu
 __all__ = str(
     """
 import_stream
+scan_aux
 bibtexify_one
+get_style_class
 get_style_or_die
 export_to_bibtex
+export_to_bibtex_file
+watch_export
 write_bibtexified
 """
 ).split()
@@ -161,8 +170,7 @@ def _convert_bibtex_record(rec):
         if kind == "arxiv" and arxiv is None:
             arxiv = info
 
-    # Gather reference information. TODO: infer ISSN, normalize journal name,
-    # pages...
+    # Gather reference information.
 
     refdata = {"_type": rec["type"]}
 
@@ -194,6 +202,10 @@ def _convert_bibtex_record(rec):
             continue
         refdata[k] = v
 
+    # Tidy it up. Inferring missing information from the rest of the library
+    # is left to "bib normalize".
+    normalize_refdata(refdata, default_normalizers())
+
     # All done.
 
     return dict(
@@ -231,20 +243,116 @@ def import_stream(app, bibstream):
         app.db.learn_pub(info)
 
 
+# Scanning LaTeX .aux files
+
+# Anchoring on a literal newline rather than "^" lets the regex engine search
+# ahead for its prefix, which makes a big difference on large files. biblatex writes
+# "\\abx@aux@cite{refsection}{key}"; the interesting argument is always the
+# last one.
+_aux_line_re = re.compile(
+    rb"\n\\(citation|abx@aux@cite|@input|bibdata)"
+    rb"(?:\{[^{}\n]*\})*\{([^{}\n]*)\}[ \t\r]*(?=\n)"
+)
+
+
+class AuxScanResult(object):
+    """The citations and BibTeX databases named in a LaTeX .aux file and
+    everything that it includes. `citations` is in the order that we came
+    across them, with duplicates removed. `paths` lists the .aux files that
+    were read.
+
+    """
+
+    def __init__(self):
+        self.citations = []
+        self.bibdata = []
+        self.paths = []
+
+
+def scan_aux(path, stream=None):
+    """Find the citations in the .aux file at `path`, following "\\@input"
+    includes, which LaTeX uses for the .aux files of "\\include"d chapters.
+    Handles both BibTeX ("\\citation") and biblatex ("\\abx@aux@cite")
+    citations. If `stream` is given, the top-level file is read from it
+    rather than opened. Returns an AuxScanResult.
+
+    """
+    import os.path
+
+    result = AuxScanResult()
+    cites = []
+
+    if stream is None:
+        basedir = os.path.dirname(path)
+    else:
+        basedir = ""
+
+    todo = [(path, stream)]
+    visited = set()
+
+    while len(todo):
+        path, stream = todo.pop()
+
+        if stream is None:
+            key = os.path.abspath(path)
+            if key in visited:
+                continue
+            visited.add(key)
+
+            try:
+                with open(path, "rb") as f:
+                    text = f.read()
+            except OSError as e:
+                if len(result.paths):
+                    # An include of a chapter that hasn't been compiled yet.
+                    warn('cannot read included aux file "%s": %s', path, e)
+                    continue
+                raise
+        else:
+            text = getattr(stream, "buffer", stream).read()
+
+        result.paths.append(path)
+        includes = []
+
+        for cmd, arg in _aux_line_re.findall(b"\n" + text + b"\n"):
+            if cmd == b"citation" or cmd == b"abx@aux@cite":
+                cites.append(arg)
+            elif cmd == b"@input":
+                includes.append((os.path.join(basedir, arg.decode("utf8")), None))
+            elif cmd == b"bibdata":
+                for db in arg.decode("utf8").split(","):
+                    if db not in result.bibdata:
+                        result.bibdata.append(db)
+
+        # We use `todo` as a stack, so reverse to visit includes in order.
+        todo.extend(reversed(includes))
+
+    # Splitting everything at once and deduplicating with a dict is a lot
+    # faster than handling the keys one at a time. We provide a mechanism for
+    # ignoring raw bibtex entries.
+    keys = dict.fromkeys(b",".join(cites).decode("utf8").split(","))
+    result.citations = [k for k in keys if len(k) and not k.startswith("r.")]
+    return result
+
+
 # Export
 
 
 class BibtexStyleBase(object):
+    name = None
+    cacheable = True  # whether rendered entries can go in the bibtex_cache table
     include_doi = True
     include_title_all = False
     issn_name_map = None
+    source_stamps = None  # of the file defining the style; see get_style_class()
     normalize_pages = False
     aggressive_url = True
     title_types = set((b"book",))
 
     def render_name(self, name):
-        given, family = parse_name(name)
+        return self._render_parsed_name(*parse_name(name))
 
+    def _render_parsed_name(self, given, family):
         if len(given):
             givenbit = b", " + unicode_to_latex(given)
         else:
@@ -262,31 +370,62 @@ class BibtexStyleBase(object):
         return b"{%s}%s" % (unicode_to_latex(fbits[0]), givenbit)
 
     def render_names(self, names):
-        return b" and ".join(self.render_name(n) for n in names)
+        render = self._render_parsed_name
+        return b" and ".join([render(g, f) for g, f in parse_names(names)])
 
     def _massage_info(self, info, rd):
         pass
 
-    def render_info(self, info):
+    def fingerprint(self):
+        """Returns a string summarizing the files, besides the database, that
+        our output depends on -- the code of the style and its ISSN map -- or
+        None if there aren't any. Rendered entries are cached under it, and it
+        goes into the digests of exported files."""
+
+        from hashlib import sha1
+
+        parts = []
+
+        if self.source_stamps:
+            parts.append(repr(self.source_stamps))
+        if self.issn_name_map is not None:
+            parts.append(self.issn_name_map.fingerprint())
+
+        if not len(parts):
+            return None
+        return sha1("\n".join(parts).encode("utf8")).hexdigest()[:16]
+
+    def render_info(self, info, journal_latex=None):
         """Returns a dict in which the values are already latex-encoded. '_type' is
         the bibtex type, '_ident' is the bibtex identifier.
 
         We process an 'info' dictionary so that we can process BibTeX records that
-        haven't actually been ingested into the database.
+        haven't actually been ingested into the database. For ones that have,
+        `journal_latex` can be the LaTeX form of the journal name from the
+        journals table, which saves us from recomputing it.
 
         """
         rd = dict(info["refdata"])
 
         for k in list(rd.keys()):
-            rd[k] = unicode_to_latex(rd[k])
+            if k == "journal" and journal_latex is not None:
+                rd[k] = journal_latex
+            else:
+                rd[k] = unicode_to_latex(rd[k])
 
         self._massage_info(info, rd)
 
+        truncated = info.get("truncated") or {}
+
         if len(info.get("authors") or []):
             rd["author"] = self.render_names(info["authors"])
+            if "author" in truncated:
+                rd["author"] += b" and others"
 
         if len(info.get("editors") or []):
             rd["editor"] = self.render_names(info["editors"])
+            if "editor" in truncated:
+                rd["editor"] += b" and others"
 
         if self.include_doi and info.get("doi") is not None:
             rd["doi"] = unicode_to_latex(info["doi"])
@@ -348,20 +487,11 @@ class BibtexStyleBase(object):
 
 
 class ApjBibtexStyle(BibtexStyleBase):
+    name = "apj"
     normalize_pages = True
 
-    def __init__(self):
-        inm = {}
-
-        for line in datastream("apj-issnmap.txt"):
-            line = line.split(b"#")[0].strip().decode("utf-8")
-            if not len(line):
-                continue
-
-            issn, jname = line.split(None, 1)
-            inm[issn] = unicode_to_latex(jname)
-
-        self.issn_name_map = inm
+    # Shared and loaded lazily, so constructing a style is free.
+    issn_name_map = get_issn_map("apj")
 
     def _massage_info(self, info, rd):
         if rd.get("issn") == "1996-756X":
@@ -382,6 +512,7 @@ class ApjBibtexStyle(BibtexStyleBase):
 
 
 class NsfBibtexStyle(BibtexStyleBase):
+    name = "nsf"
     normalize_pages = True
     include_title_all = True
 
@@ -399,18 +530,120 @@ class NsfBibtexStyle(BibtexStyleBase):
             del rd["note"]
 
 
-bibtex_styles = {
-    "apj": ApjBibtexStyle,
-    "nsf": NsfBibtexStyle,
+# The style registry. Styles are found, in order of precedence:
+#
+# 1. Among the builtins listed here;
+# 2. As a file "<name>.py" in the "styles" subdirectory of the bib data
+#    directory, which must define a BibtexStyleBase subclass named "Style";
+# 3. As an entry point named "<name>" in the "bibtools.styles" group.
+#
+# Nothing is imported until a style is actually requested, and later sources
+# can't shadow earlier ones, since rendered entries are cached in the
+# database by style name. We note the stamp of the file that each style was
+# loaded from, so that editing it invalidates the cached entries, and reload
+# user style files that have changed since we loaded them.
+
+_builtin_styles = {
+    "apj": "bibtools.bibtex:ApjBibtexStyle",
+    "nsf": "bibtools.bibtex:NsfBibtexStyle",
 }
 
+_style_classes = {}
+_user_style_paths = {}
+
+
+def _import_ref(ref):
+    import importlib
+
+    modname, clsname = ref.split(":", 1)
+    return getattr(importlib.import_module(modname), clsname)
+
+
+def _load_user_style(name):
+    import importlib.util
+    import os.path
+
+    path = bibpath("styles", name + ".py")
+    if not os.path.exists(path):
+        return None
+
+    spec = importlib.util.spec_from_file_location("bibtools_user_styles." + name, path)
+    mod = importlib.util.module_from_spec(spec)
+
+    try:
+        spec.loader.exec_module(mod)
+        return mod.Style
+    except Exception as e:
+        die('failed to load BibTeX style "%s" from "%s": %s', name, path, e)
+
+
+def _load_entry_point_style(name):
+    from importlib.metadata import entry_points
+
+    for ep in entry_points(group="bibtools.styles", name=name):
+        try:
+            return ep.load()
+        except Exception as e:
+            die('failed to load BibTeX style "%s" from "%s": %s', name, ep.value, e)
+
+    return None
+
+
+def get_style_class(name):
+    """Get the class implementing the named BibTeX style, importing it if
+    needed, or None if there is no such style."""
+
+    import sys
+
+    cls = _style_classes.get(name)
+    if cls is not None:
+        path = _user_style_paths.get(name)
+        if path is None or file_stamps([path]) == cls.source_stamps:
+            return cls
+
+    path = None
+
+    if name in _builtin_styles:
+        cls = _import_ref(_builtin_styles[name])
+    elif "/" in name or name.startswith("."):
+        return None
+    else:
+        cls = _load_user_style(name)
+        if cls is not None:
+            path = _user_style_paths[name] = bibpath("styles", name + ".py")
+        else:
+            cls = _load_entry_point_style(name)
+        if cls is None:
+            return None
+
+    if not (isinstance(cls, type) and issubclass(cls, BibtexStyleBase)):
+        die('BibTeX style "%s" is not a subclass of BibtexStyleBase', name)
+
+    # A style that subclasses another inherits its name, so only hold the
+    # class to a name that it sets itself.
+    if cls.__dict__.get("name") is None:
+        cls.name = name
+    elif cls.name != name:
+        die(
+            'BibTeX style registered as "%s" calls itself "%s"; they must agree',
+            name,
+            cls.name,
+        )
+
+    if path is None:
+        path = getattr(sys.modules.get(cls.__module__), "__file__", None)
+    cls.source_stamps = file_stamps([path]) if path is not None else []
+
+    _style_classes[name] = cls
+    return cls
+
 
 def get_style_or_die(name):
-    factory = bibtex_styles.get(name)
-    if factory is None:
+    cls = get_style_class(name)
+    if cls is None:
         die('unrecognized BibTeX output style "%s"', name)
 
-    return factory()
+    return cls()
 
 
 def write_bibtexified(write, btdata):
@@ -438,32 +671,90 @@ def write_bibtexified(write, btdata):
     write(b"\n}\n")
 
 
-def export_to_bibtex(app, style, citednicks, write=None, ignore_missing=False):
-    if write is None:
-        from pwkit.io import get_stdout_bytes
+def _render_pubs(app, style, todo, memo=None, revs=None):
+    """Render BibTeX for pubs in the database. `todo` is a list of `(nickname,
+    pub)`. Returns a dict mapping nicknames to the rendered entries. We use
+    the cache where we can, and fill it in where we can't.
+
+    Long-running callers can also pass `memo`, a dict that we use to remember
+    entries in-process keyed by `(nickname, pubid, revision, fingerprint)`,
+    along with `revs`, the current revisions from BibDB.get_pub_revisions().
+
+    """
+    result = {}
+    fingerprint = style.fingerprint()
+
+    if memo is not None:
+        remaining = []
+
+        for nick, pub in todo:
+            data = memo.get((nick, pub.id, revs[pub.id], fingerprint))
+            if data is None:
+                remaining.append((nick, pub))
+            else:
+                result[nick] = data
+
+        todo = remaining
+
+    if not len(todo):
+        return result
+
+    if style.cacheable and style.name is not None:
+        cachekey = style.name
+        if fingerprint is not None:
+            cachekey += "@" + fingerprint
+        rendered = app.db.get_cached_bibtex(cachekey, (t[1].id for t in todo))
+    else:
+        cachekey = None
+        rendered = {}
+
+    misses = []
+
+    for nick, pub in todo:
+        data = rendered.get((pub.id, nick))
+        if data is None:
+            misses.append((nick, pub))
+        else:
+            result[nick] = data
+
+    fresh = []
+    journals = app.db.get_journal_latex(set(t[1].journalid for t in misses))
+
+    for (nick, pub), info in zip(misses, app.db.jsonify_pubs(t[1] for t in misses)):
+        bt = style.render_info(info, journals.get(pub.journalid))
+        bt["_ident"] = nick.encode("utf8")
+        chunks = []
+        write_bibtexified(chunks.append, bt)
+        result[nick] = b"".join(chunks)
+        fresh.append((pub.id, nick, result[nick]))
+
+    if len(fresh) and cachekey is not None:
+        app.db.cache_bibtex(cachekey, fresh)
+
+    if memo is not None:
+        for nick, pub in todo:
+            memo[nick, pub.id, revs[pub.id], fingerprint] = result[nick]
+
+    return result
 
-        write = get_stdout_bytes().write
 
+def _resolve_citations(app, citednicks, ignore_missing):
+    """Returns a sorted list of `(nickname, pub)` for the cited nicknames,
+    resolved all in one go, dying if there's anything we can't export."""
+
+    citednicks = sorted(citednicks)
+    known = app.db.locate_nicknames(citednicks)
     seenids = {}
-    first = True
+    todo = []
 
-    for nick in sorted(citednicks):
-        curs = app.db.pub_fquery(
-            "SELECT p.* FROM pubs AS p, nicknames AS n "
-            "WHERE p.id == n.pubid AND n.nickname == ?",
-            nick,
-        )
-        res = list(curs)
+    for nick in citednicks:
+        pub = known.get(nick)
 
-        if not len(res):
+        if pub is None:
             if ignore_missing:
                 continue
             else:
                 die('citation to unrecognized nickname "%s"', nick)
-        if len(res) != 1:
-            die('cant-happen multiple matches for nickname "%s"', nick)
-
-        pub = res[0]
 
         if pub.id in seenids:
             die(
@@ -477,19 +768,317 @@ def export_to_bibtex(app, style, citednicks, write=None, ignore_missing=False):
             die('no reference data for "%s"', nick)
 
         seenids[pub.id] = nick
+        todo.append((nick, pub))
+
+    return todo
+
 
+def _write_entries(write, rendered, todo):
+    first = True
+
+    for nick, pub in todo:
         if first:
             first = False
         else:
             write(b"\n")
 
-        bt = style.render_info(app.db.jsonify_pub(pub.id))
-        bt["_ident"] = nick.encode("utf8")
-        write_bibtexified(write, bt)
+        write(rendered[nick])
+
+
+def export_to_bibtex(app, style, citednicks, write=None, ignore_missing=False):
+    if write is None:
+        from pwkit.io import get_stdout_bytes
+
+        write = get_stdout_bytes().write
+
+    todo = _resolve_citations(app, citednicks, ignore_missing)
+    _write_entries(write, _render_pubs(app, style, todo), todo)
+
+
+_digest_prefix = b"% bibtools-digest: "
+
+
+def _export_digest(style, todo, revs):
+    """Summarize everything that goes into an export: the style and the files
+    it depends on, the cited nicknames, and the revisions of the records that
+    they resolve to."""
+
+    from hashlib import sha1
+
+    s = sha1(("%s %s\n" % (style.name, style.fingerprint())).encode("utf8"))
+
+    for nick, pub in todo:
+        s.update(("%s %d %d\n" % (nick, pub.id, revs[pub.id])).encode("utf8"))
+
+    return s.hexdigest().encode("ascii")
+
+
+def export_to_bibtex_file(
+    app, style, citednicks, path, ignore_missing=False, memo=None
+):
+    """Like export_to_bibtex(), but writing to the file `path`. The first line
+    of the file records a digest of what went into it, and if nothing has
+    changed the file is left alone, so that LaTeX build tools don't see a
+    reason to rerun BibTeX. Returns whether the file was rewritten. See
+    _render_pubs() for `memo`.
+
+    """
+    import os
+    from tempfile import NamedTemporaryFile
+
+    todo = _resolve_citations(app, citednicks, ignore_missing)
+    revs = app.db.get_pub_revisions([t[1].id for t in todo])
+    header = _digest_prefix + _export_digest(style, todo, revs) + b"\n"
+
+    try:
+        with open(path, "rb") as f:
+            if f.readline() == header:
+                return False
+    except FileNotFoundError:
+        pass
+
+    rendered = _render_pubs(app, style, todo, memo=memo, revs=revs)
+
+    # Write atomically, so that nobody ever sees a partial file.
+    dest_dir = os.path.dirname(os.path.abspath(path))
+    with NamedTemporaryFile(
+        mode="wb", dir=dest_dir, prefix=".bibtools.", delete=False
+    ) as f:
+        f.write(header)
+        f.write(b"\n")
+        _write_entries(f.write, rendered, todo)
+
+    # NamedTemporaryFile makes files that only we can read.
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = default_file_mode()
+
+    os.chmod(f.name, mode)
+    os.replace(f.name, path)
+    return True
+
+
+class _ChangeWaiter(object):
+    """Wait for files to change, using inotify if the optional `inotify_simple`
+    module is available, and polling otherwise. Either way, the caller checks
+    for itself what actually changed; inotify just wakes us up promptly."""
+
+    poll_interval = 1.0  # seconds
+
+    def __init__(self):
+        try:
+            from inotify_simple import INotify, flags
+        except ImportError:
+            self._inotify = None
+        else:
+            self._inotify = INotify()
+            self._mask = (
+                flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.MODIFY
+            )
+            self._watched = set()
+
+    def watch(self, paths):
+        import os
+
+        if self._inotify is None:
+            return
+
+        # We watch directories because LaTeX and SQLite both like to replace
+        # files rather than modify them in place.
+        for path in paths:
+            d = os.path.dirname(os.path.abspath(path))
+            if d not in self._watched:
+                self._inotify.add_watch(d, self._mask)
+                self._watched.add(d)
+
+    def wait(self):
+        import time
+
+        if self._inotify is None:
+            time.sleep(self.poll_interval)
+        else:
+            # The timeout (in ms) is just a safety net in case we miss events.
+            self._inotify.read(timeout=10000)
+            time.sleep(0.1)  # let bursts of events settle
+            self._inotify.read(timeout=0)
+
+
+def watch_export(app, style, auxpath, path, ignore_missing=False):
+    """Keep the BibTeX file `path` up to date with the citations in the .aux
+    file `auxpath` and the records in the database, until interrupted. The
+    style and the rendered entries stay in memory between updates."""
+
+    import sys
+    from .db import dbpath
+
+    dbpaths = [dbpath, dbpath + "-wal"]
+    waiter = _ChangeWaiter()
+    memo = {}
+    aux = aux_stamps = db_stamps = None
+    last_error = None
+
+    while True:
+        error = None
+
+        try:
+            new_aux_stamps = None if aux is None else file_stamps(aux.paths)
+
+            if aux is None or new_aux_stamps != aux_stamps:
+                aux = scan_aux(auxpath)
+                new_aux_stamps = file_stamps(aux.paths)
+                waiter.watch(aux.paths)
+                db_stamps = None  # force a check
+
+            new_db_stamps = file_stamps(dbpaths)
+
+            if new_aux_stamps != aux_stamps or new_db_stamps != db_stamps:
+                aux_stamps = new_aux_stamps
+                db_stamps = new_db_stamps
+
+                if export_to_bibtex_file(
+                    app,
+                    style,
+                    aux.citations,
+                    path,
+                    ignore_missing=ignore_missing,
+                    memo=memo,
+                ):
+                    print(
+                        "[Wrote %s: %d citations]" % (path, len(aux.citations)),
+                        file=sys.stderr,
+                    )
+
+                # Don't sit on a stale read transaction, and save anything we
+                # added to the cache. Our own commit may touch the database
+                # files, so re-stamp them afterwards.
+                app.db.commit()
+                db_stamps = file_stamps(dbpaths)
+                waiter.watch(dbpaths)
+        except SystemExit as e:
+            # die() was called, probably because of a bad citation. Say so
+            # and wait for the user to fix things.
+            error = str(e)
+            app.db.rollback()
+            aux_stamps = file_stamps(aux.paths) if aux is not None else None
+        except OSError as e:
+            # Most likely the .aux file doesn't exist (yet).
+            error = "warning: %s" % e
+            aux = None
+
+        if error is not None and error != last_error:
+            print(error, file=sys.stderr)
+        last_error = error
+
+        try:
+            waiter.wait()
+        except KeyboardInterrupt:
+            return
 
 
 # Merging
 
+# This must agree with how BibTexParser decides where records start: any line
+# whose first non-blank character is "@". We add a leading newline to the data
+# so that the pattern can start with a literal, which is a lot faster than
+# using "^" on big files.
+_bib_record_start_re = re.compile(rb"\n[ \t]*@")
+_bib_record_head_re = re.compile(rb"[ \t]*@([^{\n]*)\{([^,\n]*)")
+
+
+def _index_bibtex_data(data):
+    """Find the byte extents of the records in some BibTeX data. Returns
+    `(strings, entries)`, where `strings` is a list of `(offset, length)` for
+    the @string definitions, which every record may need, and `entries` is a
+    dict mapping citation keys to `(offset, length)`.
+
+    """
+    stop = data.find(b"--BREAK--")
+    if stop >= 0:
+        data = data[: data.rfind(b"\n", 0, stop) + 1]
+
+    starts = [m.start() for m in _bib_record_start_re.finditer(b"\n" + data)]
+    starts.append(len(data))
+    strings = []
+    entries = {}
+
+    for i in range(len(starts) - 1):
+        ofs = starts[i]
+        m = _bib_record_head_re.match(data, ofs)
+        if m is None:
+            continue
+
+        btype = m.group(1).strip().lower()
+        extent = (ofs, starts[i + 1] - ofs)
+
+        if btype == b"string":
+            strings.append(extent)
+        elif btype not in (b"comment", b"preamble"):
+            key = m.group(2).strip().rstrip(b"}").decode("utf8")
+            entries[key] = extent  # like the full parse, last one wins
+
+    return strings, entries
+
+
+def _get_bibtex_index(path):
+    """Get the index of the BibTeX file at `path`, using a cached copy stored
+    next to it if the file hasn't changed since that was made."""
+
+    import os
+
+    st = os.stat(path)
+    stamp = [st.st_mtime_ns, st.st_size]
+    dirname, basename = os.path.split(path)
+    idxpath = os.path.join(dirname, "." + basename + ".bibtools-index")
+
+    try:
+        with open(idxpath, "rt") as f:
+            cached = json.load(f)
+        if cached["stamp"] == stamp:
+            return cached["strings"], cached["entries"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    with open(path, "rb") as f:
+        strings, entries = _index_bibtex_data(f.read())
+
+    try:
+        with open(idxpath, "wt") as f:
+            json.dump(dict(stamp=stamp, strings=strings, entries=entries), f)
+    except OSError:
+        pass  # e.g. read-only directory; no big deal
+
+    return strings, entries
+
+
+def load_bibtex_records(path, keys):
+    """Parse and convert just the records with the specified citation keys from
+    the BibTeX file at `path`. Returns a dict mapping keys to info dicts;
+    keys that aren't in the file are left out.
+
+    """
+    import io
+
+    strings, entries = _get_bibtex_index(path)
+    wanted = [entries[k] for k in keys if k in entries]
+    if not len(wanted):
+        return {}
+
+    chunks = []
+
+    with open(path, "rb") as f:
+        for ofs, length in strings + sorted(wanted):
+            f.seek(ofs)
+            chunks.append(f.read(length))
+
+    text = b"".join(chunks).decode("utf8").replace("\r\n", "\n")
+    result = {}
+
+    for info in _convert_bibtex_stream(io.StringIO(text)):
+        result[info["nicknames"][0]] = info
+
+    return result
+
 
 def merge_with_bibtex(app, bibpath, style, citednicks, write=None):
     if write is None:
@@ -497,39 +1086,22 @@ def merge_with_bibtex(app, bibpath, style, citednicks, write=None):
 
         write = get_stdout_bytes().write
 
-    # First, load up all of the existing records.
-
-    existing = {}
-
-    with open(bibpath, "r") as f:
-        for info in _convert_bibtex_stream(f):
-            existing[info["nicknames"][0]] = info
-
-    # Now see which cited nicknames are ones we know about.
+    # See which cited nicknames are ones we know about.
 
     seenids = {}
     recognized = {}
     first = True
     sorted_cited = sorted(citednicks)
+    known = app.db.locate_nicknames(sorted_cited)
 
     for nick in sorted_cited:
-        curs = app.db.pub_fquery(
-            "SELECT p.* FROM pubs AS p, nicknames AS n "
-            "WHERE p.id == n.pubid AND n.nickname == ?",
-            nick,
-        )
-        res = list(curs)
+        pub = known.get(nick)
 
-        if not len(res):
+        if pub is None:
             # if nick not in existing:
             #    die ('citation to unrecognized nickname "%s"', nick)
             continue
 
-        if len(res) != 1:
-            die('cant-happen multiple matches for nickname "%s"', nick)
-
-        pub = res[0]
-
         if pub.id in seenids:
             die(
                 '"%s" and "%s" refer to the same publication; this will '
@@ -542,17 +1114,23 @@ def merge_with_bibtex(app, bibpath, style, citednicks, write=None):
             die('no reference data for "%s"', nick)
 
         seenids[pub.id] = nick
-        recognized[nick] = pub.id
+        recognized[nick] = pub
+
+    rendered = _render_pubs(app, style, list(recognized.items()))
+
+    # Only the leftovers need to come from the existing BibTeX file.
+
+    existing = load_bibtex_records(
+        bibpath, [n for n in sorted_cited if n not in recognized]
+    )
 
     # Now we can output the merged collection.
 
     for nick in sorted_cited:
-        if nick in recognized:
-            info = app.db.jsonify_pub(recognized[nick])
-        else:
-            info = existing.get(nick)
+        data = rendered.get(nick)
+        info = existing.get(nick)
 
-        if info is None:
+        if data is None and info is None:
             warn('skipping "%s"', nick)
             continue
 
@@ -561,6 +1139,9 @@ def merge_with_bibtex(app, bibpath, style, citednicks, write=None):
         else:
             write(b"\n")
 
-        bt = style.render_info(info)
-        bt["_ident"] = nick.encode("utf8")
-        write_bibtexified(write, bt)
+        if data is not None:
+            write(data)
+        else:
+            bt = style.render_info(info)
+            bt["_ident"] = nick.encode("utf8")
+            write_bibtexified(write, bt)
@@ -8,7 +8,6 @@ The command-line interface.
 
 import codecs
 import io
-import json
 import os
 import sys
 
@@ -21,51 +20,84 @@ from . import webutil as wu
 __all__ = ["driver"]
 
 
+class Author(multitool.Command):
+    name = "author"
+    argspec = "<surname> [initials]"
+    summary = "List publications in the database by an author."
+    more_help = """Authors in any position are matched. Surnames are compared in normalized
+form, so that "muller" matches "Müller". If initials are given, like "PK" or
+"P. K.", the author's initials must start with them."""
+
+    def invoke(self, args, app=None, **kwargs):
+        if len(args) not in (1, 2):
+            raise multitool.UsageError("expected 1 or 2 arguments")
+
+        surname = args[0]
+        initials = None
+
+        if len(args) > 1:
+            initials = "".join(c for c in args[1] if c.isalpha()).upper()
+
+        print_generic_listing(app.db, app.db.locate_author_pubs(surname, initials))
+
+
 class Btexport(multitool.Command):
     name = "btexport"
-    argspec = "[-i] <output-style> <aux-file>"
+    argspec = "[-i] [--watch] <output-style> <aux-file> [bib-file]"
     summary = "Dump BibTeX entries needed for an .aux file."
     more_help = """If the "-i" option is provided, missing entries are ignored; if not, the
-program exits with an error if any are encountered."""
+program exits with an error if any are encountered.
+
+If a BibTeX file is named, the entries are written there rather than to
+standard output, and the file is only rewritten if the set of citations or
+the cited records have changed since the last time.
+
+With "--watch", which requires a BibTeX file, the program keeps running and
+updates the BibTeX file whenever the .aux file or the database changes."""
 
     def invoke(self, args, app=None, **kwargs):
-        from .bibtex import get_style_or_die, export_to_bibtex
+        from .bibtex import (
+            get_style_or_die,
+            export_to_bibtex,
+            export_to_bibtex_file,
+            scan_aux,
+            watch_export,
+        )
 
         ignore_missing = pop_option("i", args)
+        watch = pop_option("watch", args)
 
-        if len(args) != 2:
-            raise multitool.UsageError("expected exactly 2 arguments")
+        if len(args) not in (2, 3):
+            raise multitool.UsageError("expected 2 or 3 arguments")
 
         stylename = args[0]
         auxfile = args[1]
+        bibfile = args[2] if len(args) > 2 else None
 
         style = get_style_or_die(stylename)
 
-        # Load cited nicknames
-        citednicks = set()
+        if watch:
+            if bibfile is None or auxfile == "-":
+                raise multitool.UsageError(
+                    "--watch requires named .aux and BibTeX files"
+                )
+
+            watch_export(app, style, auxfile, bibfile, ignore_missing=ignore_missing)
+            return
 
+        # Load cited nicknames
         if auxfile == "-":
-            infile = sys.stdin
+            citednicks = scan_aux(auxfile, stream=sys.stdin).citations
         else:
-            infile = io.open(auxfile, "rt")
-
-        for line in infile:
-            if not line.startswith(r"\citation{"):
-                continue
-
-            line = line.rstrip()
-
-            if line[-1] != "}":
-                warn('unexpected cite line in LaTeX aux file: "%s"', line)
-                continue
-
-            entries = line[10:-1]
-
-            # We provide a mechanism for ignoring raw bibtex entries
-            citednicks.update([e for e in entries.split(",") if not e.startswith("r.")])
+            citednicks = scan_aux(auxfile).citations
 
         # Ready to write
-        export_to_bibtex(app, style, citednicks, ignore_missing=ignore_missing)
+        if bibfile is None:
+            export_to_bibtex(app, style, citednicks, ignore_missing=ignore_missing)
+        else:
+            export_to_bibtex_file(
+                app, style, citednicks, bibfile, ignore_missing=ignore_missing
+            )
 
 
 class Btmerge(multitool.Command):
@@ -76,7 +108,7 @@ class Btmerge(multitool.Command):
     )
 
     def invoke(self, args, app=None, **kwargs):
-        from .bibtex import get_style_or_die, merge_with_bibtex
+        from .bibtex import get_style_or_die, merge_with_bibtex, scan_aux
 
         if len(args) != 3:
             raise multitool.UsageError("expected exactly 3 arguments")
@@ -88,22 +120,7 @@ class Btmerge(multitool.Command):
         style = get_style_or_die(stylename)
 
         # Load cited nicknames
-        citednicks = set()
-
-        for line in io.open(auxfile, "rt"):
-            if not line.startswith(r"\citation{"):
-                continue
-
-            line = line.rstrip()
-
-            if line[-1] != "}":
-                warn('unexpected cite line in LaTeX aux file: "%s"', line)
-                continue
-
-            entries = line[10:-1]
-
-            # We provide a mechanism for ignoring raw bibtex entries
-            citednicks.update([e for e in entries.split(",") if not e.startswith("r.")])
+        citednicks = scan_aux(auxfile).citations
 
         # Ready to write
         merge_with_bibtex(app, bibfile, style, citednicks)
@@ -142,19 +159,7 @@ class CanonJournal(multitool.Command):
         newjournal = args[1]
         newissn = args[2] if len(args) > 2 else None
 
-        for pub in app.db.pub_query("refdata NOT NULL"):
-            rd = json.loads(pub.refdata)
-            if rd.get("journal", "") != oldjournal:
-                continue
-
-            rd["journal"] = newjournal
-
-            if "issn" not in rd and newissn is not None:
-                rd["issn"] = newissn
-
-            app.db.execute(
-                "UPDATE pubs SET refdata = ? WHERE id == ?", (json.dumps(rd), pub.id)
-            )
+        app.db.canonicalize_journal(oldjournal, newjournal, newissn)
 
 
 class _Complete(multitool.Command):
@@ -267,11 +272,18 @@ class Edit(multitool.Command):
         textfmt.export_one(app, pub, enc, 72)
         work.close()
 
+        # Don't lock out other bib processes while the user is editing.
+        app.db.commit()
         run_editor(work.name)
 
         enc = codecs.getreader("utf-8")(open(work.name, "rb"))
         info = textfmt.import_one(enc)
-        app.db.update_pub(pub, info)
+
+        with app.db.write_transaction():
+            pub = app.db.pub_named_query("id", pub.id).fetchone()
+            if pub is None:
+                die("the publication was deleted while you were editing it")
+            app.db.update_pub(pub, info)
 
         try:
             os.unlink(work.name)
@@ -313,6 +325,64 @@ class ForgetPDF(multitool.Command):
         app.db.execute("DELETE FROM pdfs WHERE pubid == ?", (pub.id,))
 
 
+class Gc(multitool.Command):
+    name = "gc"
+    argspec = "[--history] [--vacuum]"
+    summary = "Clean up and compact the database."
+    help_if_no_args = False
+    more_help = """Deletes stray rows left behind by deleted or modified publications, including
+author names that are no longer used, and updates the statistics that SQLite
+uses to plan queries.
+
+With "--history", the reading history is trimmed to the most recent entry
+for each publication and kind of action. With "--vacuum", the database file
+is rebuilt to return the freed space to the filesystem, which can take a
+while for a big library."""
+
+    def invoke(self, args, app=None, **kwargs):
+        history = pop_option("history", args)
+        vacuum = pop_option("vacuum", args)
+
+        if len(args):
+            raise multitool.UsageError("expected no non-option arguments")
+
+        db = app.db
+        size0, free0 = db.space_usage()
+        plans0 = db.query_plans()
+
+        counts = db.collect_garbage(history=history)
+        db.commit()
+
+        for table, n in sorted(counts.items()):
+            if n:
+                print("%s: deleted %d rows" % (table, n))
+
+        db.execute("ANALYZE")
+        db.execute("PRAGMA optimize")
+        db.commit()
+
+        size1, free1 = db.space_usage()
+
+        if vacuum:
+            db.execute("VACUUM")
+            size2 = db.space_usage()[0]
+            print(
+                "database size: %.1f MiB => %.1f MiB"
+                % (size0 / 1048576, size2 / 1048576)
+            )
+        else:
+            print(
+                "database size: %.1f MiB, including %.1f MiB of free pages "
+                "(was %.1f MiB)" % (size1 / 1048576, free1 / 1048576, free0 / 1048576)
+            )
+
+        for (desc, before), (_, after) in zip(plans0, db.query_plans()):
+            if before != after:
+                print("query plan for %s:" % desc)
+                print("  before:", before)
+                print("   after:", after)
+
+
 class GoAds(multitool.Command):
     name = "go-ads"
     argspec = "<pub>"
@@ -493,12 +563,7 @@ class Group(multitool.DelegatingCommand):
                     # FIXME: check groupname to avoid "bib group add abc+12 xyz+10" mistake
                     dbgroupname = "user_" + groupname
 
-                    q = app.db.pub_fquery(
-                        "SELECT p.* FROM pubs AS p, publists AS pl "
-                        "WHERE p.id == pl.pubid AND pl.name == ? "
-                        "ORDER BY pl.idx",
-                        dbgroupname,
-                    )
+                    q = app.db.pub_named_query("group", dbgroupname)
                     print_generic_listing(app.db, q)
             except Exception as e:
                 die(e)
@@ -547,7 +612,7 @@ class Igrep(multitool.Command):
 
     def invoke(self, args, app=None, **kwargs):
         import re
-        from .bibtex import get_style_or_die
+        from .bibtex import get_style_class
 
         if len(args) != 2:
             raise multitool.UsageError("expected exactly 2 non-option arguments")
@@ -555,10 +620,14 @@ class Igrep(multitool.Command):
         stylename = args[0]
         regex = args[1].encode("utf8")
 
-        style = get_style_or_die(stylename)
+        # No need to construct the style just to get at its map.
+        factory = get_style_class(stylename)
+        if factory is None:
+            die('unrecognized BibTeX output style "%s"', stylename)
+
         comp = re.compile(regex, re.IGNORECASE)
 
-        inm = getattr(style, "issn_name_map", None)
+        inm = getattr(factory, "issn_name_map", None)
         if inm is None:
             die('style "%s" does not provide an ISSN/journal-name map', stylename)
 
@@ -586,10 +655,17 @@ class Init(multitool.Command):
 
 class Info(multitool.Command):
     name = "info"
-    argspec = "<pub>"
+    argspec = "[-a] <pub>"
     summary = "Print information about a publication."
+    more_help = """With "-a", all of the authors are listed. If only a truncated author list is
+stored in the database (see the "max-authors" setting), the full list is
+fetched from the publication's source."""
 
     def invoke(self, args, app=None, **kwargs):
+        from .db import decode_refdata
+
+        all_authors = pop_option("a", args)
+
         if len(args) != 1:
             raise multitool.UsageError("expected exactly 1 argument")
 
@@ -603,8 +679,20 @@ class Info(multitool.Command):
         year = pub.year or "no year"
         title = pub.title or "(no title)"
 
-        authors = list(app.db.get_pub_authors(pub.id))
-        if len(authors) > 10:
+        if all_authors:
+            authors = app.get_full_authors(pub)
+            ntotal = len(authors)
+        else:
+            authors = app.db.get_pub_authors(pub.id)
+            truncated = app.db.get_pub_truncations(pub.id)
+            ntotal = truncated["author"][0] if "author" in truncated else len(authors)
+
+        if all_authors and len(authors):
+            authstr = ", ".join(a[1] for a in authors)
+        elif ntotal > len(authors):
+            authstr = ", ".join(a[1] for a in authors[:10])
+            authstr += " ... (%d authors)" % ntotal
+        elif len(authors) > 10:
             authstr = ", ".join(a[1] for a in authors[:10]) + " ..."
         elif len(authors):
             authstr = ", ".join(a[1] for a in authors)
@@ -636,7 +724,7 @@ class Info(multitool.Command):
         if pub.doi is not None:
             print(red + "DOI:" + reset, pub.doi)
         if pub.refdata is not None:
-            rd = json.loads(pub.refdata)
+            rd = decode_refdata(pub.refdata)
             txt = red + "~BibTeX:" + reset + " @%s {" % rd.pop("_type")
 
             def fmt(t):
@@ -685,6 +773,56 @@ class List(multitool.Command):
         print_generic_listing(app.db, app.locate_pubs(args, noneok=True))
 
 
+class Normalize(multitool.Command):
+    name = "normalize"
+    argspec = "[-n] [normalizers...]"
+    summary = "Clean up the reference data of every publication in the database."
+    help_if_no_args = False
+    more_help = """Each publication's reference data are passed through the named
+normalizers, or all of the builtin ones ("issn", "journal", and "pages") if
+none are named. All of the changes are made in a single transaction. With
+"-n", nothing is changed, and the changes that would have been made are
+printed."""
+
+    def invoke(self, args, app=None, **kwargs):
+        from .normalize import default_normalizers, get_normalizer, normalize_library
+
+        dryrun = pop_option("n", args)
+
+        if len(args):
+            normalizers = [get_normalizer(name) for name in args]
+        else:
+            normalizers = default_normalizers()
+
+        red, green, reset = get_color_codes(sys.stdout, "red", "green", "reset")
+        nchanged = 0
+
+        try:
+            for pubid, oldrd, newrd in normalize_library(app.db, normalizers, dryrun):
+                nchanged += 1
+
+                if not dryrun:
+                    continue
+
+                print(app.db.choose_pub_nickname(pubid) or "(pub #%d)" % pubid)
+
+                for k in sorted(set(oldrd) | set(newrd)):
+                    if oldrd.get(k) == newrd.get(k):
+                        continue
+                    if k in oldrd:
+                        print(red + "-  %s: %s" % (k, oldrd[k]) + reset)
+                    if k in newrd:
+                        print(green + "+  %s: %s" % (k, newrd[k]) + reset)
+        except:
+            app.db.rollback()
+            raise
+
+        if dryrun:
+            print("[%d records would be changed]" % nchanged, file=sys.stderr)
+        else:
+            print("[Changed %d records]" % nchanged, file=sys.stderr)
+
+
 class Pdfpath(multitool.Command):
     name = "pdfpath"
     argspec = "<pub>"
@@ -750,11 +888,7 @@ class Recent(multitool.Command):
         else:
             n = 10
 
-        pubs = app.db.pub_fquery(
-            "SELECT DISTINCT p.* FROM pubs AS p, history AS h "
-            "WHERE p.id == h.pubid ORDER BY date DESC LIMIT ?",
-            n,
-        )
+        pubs = app.db.pub_named_query("recent", n)
         print_generic_listing(app.db, pubs, sort=None)
 
 
@@ -769,9 +903,7 @@ class Rmpush(multitool.Command):
         if len(args) < 1:
             raise multitool.UsageError("expected at least 1 argument")
 
-        for idtext in args:
-            pub = app.locate_or_die(idtext, autolearn=True)
-
+        for idtext, pub in zip(args, app.locate_each_or_die(args, autolearn=True)):
             sha1 = app.db.getfirstval("SELECT sha1 FROM pdfs WHERE pubid = ?", pub.id)
             if sha1 is None:
                 sha1 = app.try_get_pdf(pub)
@@ -843,6 +975,25 @@ class Rsbackup(multitool.Command):
         app.rsync_backup()
 
 
+class Serve(multitool.Command):
+    name = "serve"
+    argspec = ""
+    summary = "Run a daemon that executes bib commands without startup overhead."
+    more_help = """The daemon listens on a Unix socket in the bib data directory. While it is
+running, "bib" invocations are forwarded to it and complete much faster. If it
+isn't running, "bib" just does the work itself. Set $BIBTOOLS_NO_SERVER to
+bypass the daemon. Stop it with Control-C."""
+    help_if_no_args = False
+
+    def invoke(self, args, app=None, tool=None, **kwargs):
+        from .server import serve
+
+        if len(args) != 0:
+            raise multitool.UsageError("expected no arguments")
+
+        serve(app, tool)
+
+
 class Setpdf(multitool.Command):
     name = "setpdf"
     argspec = "<pub> <pdf-path>"
@@ -903,6 +1054,131 @@ class Setsecret(multitool.Command):
         store_user_secret(app.cfg)
 
 
+class Stats(multitool.Command):
+    name = "stats"
+    argspec = "[report] [args...]"
+    summary = "Print summary statistics about the library."
+    help_if_no_args = False
+    more_help = """Reports:
+
+  (none)                            overall counts
+  years                             publications per year
+  journals [N]                      the N (default 20) most common journals
+  authors [N]                       the N most prolific authors
+  coauthors <surname> [inits] [N]   an author's N most frequent coauthors
+  unread <group>                    the unread publications in a group
+
+The first report after the library changes takes a moment longer, since
+its summary has to be rebuilt."""
+
+    def invoke(self, args, app=None, **kwargs):
+        from .snapshot import get_snapshot
+
+        report = args[0] if len(args) else "summary"
+        func = getattr(self, "_report_" + report, None)
+        if func is None:
+            raise multitool.UsageError('unrecognized report "%s"' % report)
+
+        func(app, get_snapshot(app.db), args[1:])
+
+    def _top_n(self, args):
+        if len(args) > 1:
+            raise multitool.UsageError("expected at most 1 argument")
+
+        try:
+            return int(args[0]) if len(args) else 20
+        except ValueError:
+            raise multitool.UsageError('expected a number, not "%s"' % args[0])
+
+    def _print_counts(self, items):
+        if not len(items):
+            return
+
+        width = max(len(str(n)) for _, n in items)
+
+        for name, n in items:
+            print("%*d  %s" % (width, n, name))
+
+    def _report_summary(self, app, snap, args):
+        if len(args):
+            raise multitool.UsageError("expected no arguments")
+
+        print("publications:", len(snap.pubid))
+        print("  with PDFs:", int(snap.has_pdf.sum()))
+        print("  read:", int(snap.read.sum()))
+        print("  marked to keep:", int(snap.keep.sum()))
+
+        years = snap.year[snap.year > 0]
+        if len(years):
+            print("years: %d to %d" % (years.min(), years.max()))
+
+        print("distinct authors:", len(snap.author_names))
+        print("distinct journals:", len(snap.journal_names))
+
+    def _report_years(self, app, snap, args):
+        if len(args):
+            raise multitool.UsageError("expected no arguments")
+
+        years, counts = snap.years()
+        if not len(years):
+            return
+
+        scale = 50 / counts.max()
+        width = len(str(counts.max()))
+
+        for year, n in zip(years, counts):
+            print("%04d  %*d  %s" % (year, width, n, "#" * int(round(n * scale))))
+
+    def _report_journals(self, app, snap, args):
+        self._print_counts(snap.top_journals(self._top_n(args)))
+
+    def _report_authors(self, app, snap, args):
+        from .bibcore import parse_name
+
+        items = snap.top_authors(self._top_n(args))
+        self._print_counts([(" ".join(parse_name(a)).strip(), n) for a, n in items])
+
+    def _report_coauthors(self, app, snap, args):
+        from .bibcore import parse_name
+
+        n = 20
+        if len(args) > 1 and args[-1].isdigit():
+            n = int(args[-1])
+            args = args[:-1]
+
+        if len(args) not in (1, 2):
+            raise multitool.UsageError("expected 1 to 3 arguments")
+
+        initials = None
+        if len(args) > 1:
+            initials = "".join(c for c in args[1] if c.isalpha()).upper()
+
+        authidxs = snap.author_indices_of(app.db.locate_author_ids(args[0], initials))
+        if not len(authidxs):
+            die('no authors matching "%s"', " ".join(args))
+
+        npubs, items = snap.top_coauthors(authidxs, n)
+        print("%d publications, with:" % npubs)
+        self._print_counts([(" ".join(parse_name(a)).strip(), n) for a, n in items])
+
+    def _report_unread(self, app, snap, args):
+        if len(args) != 1:
+            raise multitool.UsageError("expected exactly 1 argument")
+
+        pubids = [
+            t[0]
+            for t in app.db.execute(
+                "SELECT pubid FROM publists WHERE name == ?", ("user_" + args[0],)
+            )
+        ]
+        if not len(pubids):
+            die('no such group "%s"', args[0])
+
+        unread = snap.unread(pubids)
+        print("%d of %d unread:" % (len(unread), len(pubids)))
+        print_generic_listing(app.db, app.db.locate_pubs_by_id(unread.tolist()))
+
+
 # Toplevel driver infrastructure
 
 HelpCommand = multitool.HelpCommand
@@ -915,6 +1191,10 @@ class Bibtool(multitool.Multitool):
     def invoke_command(self, cmd, args, app=None, **kwargs):
         from . import BibApp
 
+        if app is not None:
+            # We're running inside `bib serve`, which owns the app.
+            return super(Bibtool, self).invoke_command(cmd, args, app=app, **kwargs)
+
         with BibApp() as app:
             super(Bibtool, self).invoke_command(cmd, args, app=app, **kwargs)
 
@@ -0,0 +1,127 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2014-2022 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+"""
+The thin client for the `bib serve` daemon.
+
+This is the module behind the `bib` entry point, so it must stay cheap to
+import: only the standard library, and nothing from the rest of the package
+unless we fall back to running the command in-process. If no daemon is
+listening on the socket, we just run the full CLI ourselves.
+
+The wire protocol is simple. The client sends one line of JSON describing the
+invocation. The server replies with a sequence of frames, each consisting of
+a one-byte channel tag, a four-byte big-endian length, and a payload. Channel
+"o" is standard output, "e" is standard error, and "x" carries the exit code
+as ASCII digits and terminates the exchange.
+
+"""
+
+import json
+import os
+import socket
+import struct
+import sys
+
+__all__ = "HEADER commandline socket_path".split()
+
+
+# Commands that need our own standard input or terminal, or that shouldn't be
+# delegated to a daemon for other reasons.
+_local_commands = frozenset("edit init serve setsecret".split())
+
+HEADER = struct.Struct(">cI")
+
+
+def socket_path():
+    # This duplicates util.bibpath() so that we don't have to import it.
+    datadir = os.environ.get("XDG_DATA_HOME", os.path.expanduser("~/.local/share"))
+    return os.path.join(datadir, "bib", "server.sock")
+
+
+def _wants_local(args):
+    if os.environ.get("BIBTOOLS_NO_SERVER"):
+        return True
+    if not len(args) or args[0] in _local_commands:
+        return True
+    if "-" in args:
+        return True  # the command wants to read our stdin
+    if "--watch" in args:
+        return True  # the command would tie up the server forever
+    return False
+
+
+def _recv_exactly(sock, n):
+    chunks = []
+
+    while n > 0:
+        b = sock.recv(n)
+        if not len(b):
+            raise EOFError("bib server closed the connection unexpectedly")
+        chunks.append(b)
+        n -= len(b)
+
+    return b"".join(chunks)
+
+
+def _try_remote(args):
+    """Returns the exit code of the command, or None if no server could be
+    contacted and the caller should run the command itself."""
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        sock.connect(socket_path())
+    except OSError:
+        sock.close()
+        return None
+
+    try:
+        tty = sys.stdout.isatty()
+        columns = None
+
+        if tty:
+            try:
+                columns = os.get_terminal_size(sys.stdout.fileno()).columns
+            except OSError:
+                pass
+
+        if columns is None and "COLUMNS" in os.environ:
+            columns = os.environ["COLUMNS"]
+
+        req = dict(argv=args, cwd=os.getcwd(), tty=tty, columns=columns)
+        sock.sendall(json.dumps(req).encode("utf8") + b"\n")
+
+        outs = {b"o": sys.stdout.buffer, b"e": sys.stderr.buffer}
+
+        while True:
+            chan, n = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+            payload = _recv_exactly(sock, n)
+
+            if chan == b"x":
+                sys.stdout.flush()
+                return int(payload)
+
+            outs[chan].write(payload)
+            outs[chan].flush()
+    except (OSError, EOFError) as e:
+        # The command may have partially run, so it's not safe to retry it
+        # locally.
+        print("error: lost contact with the bib server: %s" % e, file=sys.stderr)
+        return 1
+    finally:
+        sock.close()
+
+
+def commandline():
+    args = sys.argv[1:]
+
+    if not _wants_local(args):
+        code = _try_remote(args)
+        if code is not None:
+            sys.exit(code)
+
+    from .cli import commandline
+
+    commandline()
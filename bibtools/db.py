@@ -7,26 +7,34 @@ The main database.
 """
 
 import collections
+import contextlib
 import json
+import re
 import sqlite3
 
 from .util import *
 from .bibcore import *
 
-__all__ = ("connect init").split()
+__all__ = ("connect decode_refdata encode_refdata init is_busy_error").split()
 
 
 dbpath = bibpath("db.sqlite3")
 
 
-def connect():
-    return sqlite3.connect(dbpath, factory=BibDB)
+def connect(cfg=None):
+    db = sqlite3.connect(dbpath, factory=BibDB, cached_statements=_statement_cache_size)
+    # Configure first, so that the busy timeout applies if another process is
+    # upgrading the schema at the same time as us.
+    if cfg is not None:
+        db.configure(cfg)
+    db.upgrade_schema()
+    return db
 
 
 def init(app):
     import os.path
 
-    init = datastream("schema.sql").read()
+    init = datastream("schema.sql").read().decode("utf8")
 
     mkdir_p(bibpath())
 
@@ -35,15 +43,358 @@ def init(app):
 
     try:
         app.db.executescript(init)
+        app.db.upgrade_schema()
     except sqlite3.OperationalError as e:
         die('cannot initialize "%s": %s', dbpath, e)
 
 
+# Refdata is stored as JSON so that SQLite's JSON functions, and the
+# expression indexes built on them, work on it. We write it in the most compact
+# form, with no padding and no escaping of non-ASCII characters, which is also
+# the form that SQLite itself produces for things like json_set().
+
+_refdata_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+
+def encode_refdata(rd):
+    return _refdata_encoder.encode(rd)
+
+
+def decode_refdata(text):
+    """Returns None if `text` is None, as it is for pubs without refdata."""
+    if text is None:
+        return None
+    return json.loads(text)
+
+
+# Schema upgrades. "schema.sql" creates the original version of the schema,
+# and the functions here bring it up to date, both for new and existing
+# databases. Entry N of `_upgrades` takes the schema from version N to version
+# N + 1. The version is tracked with SQLite's "user_version" pragma. Each step
+# runs in a single transaction along with the bump of the version, so that a
+# failure leaves the database as it was.
+
+
+def _execute_script(db, script):
+    # Unlike executescript(), which commits first, this runs the statements in
+    # the current transaction.
+    stmt = ""
+
+    for line in script.splitlines(True):
+        stmt += line
+
+        if sqlite3.complete_statement(stmt):
+            db.execute(stmt)
+            stmt = ""
+
+    if len(stmt.strip()):
+        raise ValueError("incomplete SQL statement: %r" % stmt)
+
+
+def _upgrade_add_bibtex_cache(db):
+    # Every pub has a revision number that is bumped whenever its record
+    # changes, and we cache rendered BibTeX keyed on it. The triggers mean
+    # that nobody has to remember to do this by hand.
+    _execute_script(
+        db,
+        """
+CREATE TABLE revisions (
+       pubid INTEGER UNIQUE PRIMARY KEY NOT NULL,
+       rev INTEGER NOT NULL,
+       FOREIGN KEY (pubid) REFERENCES pubs(id)
+);
+
+CREATE TABLE bibtex_cache (
+       pubid INTEGER NOT NULL,
+       style TEXT NOT NULL,
+       nickname TEXT NOT NULL,
+       rev INTEGER NOT NULL,
+       bibtex BLOB NOT NULL, /* output of write_bibtexified() */
+       FOREIGN KEY (pubid) REFERENCES pubs(id),
+       UNIQUE (pubid, style, nickname)
+);
+
+CREATE TRIGGER pubs_update_revision AFTER UPDATE ON pubs BEGIN
+       INSERT OR REPLACE INTO revisions VALUES (new.id,
+              ifnull((SELECT rev FROM revisions WHERE pubid == new.id), 0) + 1);
+       DELETE FROM bibtex_cache WHERE pubid == new.id;
+END;
+
+CREATE TRIGGER pubs_delete_revision AFTER DELETE ON pubs BEGIN
+       DELETE FROM revisions WHERE pubid == old.id;
+       DELETE FROM bibtex_cache WHERE pubid == old.id;
+END;
+""",
+    )
+
+
+def _upgrade_add_refdata_indexes(db):
+    # Expression indexes so that refdata can be queried with SQLite's JSON
+    # functions without a full table scan. Queries must spell the expressions
+    # exactly the same way for the indexes to be used.
+    _execute_script(
+        db,
+        """
+CREATE INDEX pubs_refdata_journal ON pubs(json_extract(refdata, '$.journal'));
+CREATE INDEX pubs_refdata_issn ON pubs(json_extract(refdata, '$.issn'));
+""",
+    )
+
+
+def _upgrade_split_author_names(db):
+    # Store the parsed components of each name, so that reads don't need to
+    # reparse them and surname searches can use an index.
+    _execute_script(
+        db,
+        """
+ALTER TABLE author_names ADD COLUMN given TEXT;
+ALTER TABLE author_names ADD COLUMN family TEXT;
+ALTER TABLE author_names ADD COLUMN nsurname TEXT; /* normalize_surname(family) */
+""",
+    )
+
+    rows = db.execute("SELECT oid, name FROM author_names").fetchall()
+    parsed = parse_names(r[1] for r in rows)
+    db.executemany(
+        "UPDATE author_names SET given = ?, family = ?, nsurname = ? WHERE oid == ?",
+        (
+            (given, family, nsurname, oid)
+            for (oid, _), (given, family), nsurname in zip(
+                rows, parsed, normalize_surnames(p[1] for p in parsed)
+            )
+        ),
+    )
+
+    db.execute("CREATE INDEX author_names_nsurname ON author_names(nsurname)")
+
+
+def _upgrade_add_author_indexes(db):
+    # For going from names to pubs, and for fetching a pub's authors without a
+    # table scan.
+    _execute_script(
+        db,
+        """
+CREATE INDEX authors_authid ON authors(authid);
+CREATE INDEX authors_pubid ON authors(pubid);
+""",
+    )
+
+
+def _upgrade_add_truncated_authors(db):
+    # When the "max-authors" setting is in effect, we only store the first
+    # few authors of huge author lists, and note the truncation here.
+    _execute_script(
+        db,
+        """
+CREATE TABLE truncated_authors (
+       pubid INTEGER NOT NULL,
+       type INTEGER NOT NULL,
+       total INTEGER NOT NULL, /* length of the untruncated list */
+       collab TEXT, /* encoded name of the collaboration, if we spotted one */
+       FOREIGN KEY (pubid) REFERENCES pubs(id),
+       UNIQUE (pubid, type)
+);
+""",
+    )
+
+
+def _upgrade_add_pubid_indexes(db):
+    # So that the bulk operations, which join these tables against batches of
+    # pubids, don't make SQLite build a temporary index for every batch.
+    _execute_script(
+        db,
+        """
+CREATE INDEX nicknames_pubid ON nicknames(pubid);
+CREATE INDEX pdfs_pubid ON pdfs(pubid);
+CREATE INDEX publists_pubid ON publists(pubid);
+""",
+    )
+
+
+def _upgrade_add_library_revision(db):
+    # A revision number for the library as a whole, bumped by any change that
+    # could affect the summaries made by "bib stats", so that it can tell when
+    # its cached snapshot is out of date. History entries only count if they
+    # are "read" actions.
+    _execute_script(
+        db,
+        """
+CREATE TABLE library_revision (rev INTEGER NOT NULL);
+INSERT INTO library_revision VALUES (0);
+
+CREATE TRIGGER pubs_insert_librev AFTER INSERT ON pubs BEGIN
+       UPDATE library_revision SET rev = rev + 1;
+END;
+CREATE TRIGGER pubs_update_librev AFTER UPDATE ON pubs BEGIN
+       UPDATE library_revision SET rev = rev + 1;
+END;
+CREATE TRIGGER pubs_delete_librev AFTER DELETE ON pubs BEGIN
+       UPDATE library_revision SET rev = rev + 1;
+END;
+CREATE TRIGGER pdfs_insert_librev AFTER INSERT ON pdfs BEGIN
+       UPDATE library_revision SET rev = rev + 1;
+END;
+CREATE TRIGGER pdfs_delete_librev AFTER DELETE ON pdfs BEGIN
+       UPDATE library_revision SET rev = rev + 1;
+END;
+CREATE TRIGGER history_insert_librev AFTER INSERT ON history WHEN new.action == 1 BEGIN
+       UPDATE library_revision SET rev = rev + 1;
+END;
+CREATE TRIGGER history_delete_librev AFTER DELETE ON history WHEN old.action == 1 BEGIN
+       UPDATE library_revision SET rev = rev + 1;
+END;
+""",
+    )
+
+
+@contextlib.contextmanager
+def _without_update_triggers(db):
+    # For upgrades that rewrite pubs without changing their content: take the
+    # update triggers out of the way rather than let them bump every revision
+    # and flush the caches.
+    triggers = db.execute(
+        "SELECT name, sql FROM sqlite_master "
+        "WHERE type == 'trigger' AND tbl_name == 'pubs' AND name LIKE 'pubs_update_%'"
+    ).fetchall()
+
+    for name, _ in triggers:
+        db.execute("DROP TRIGGER %s" % name)
+
+    yield
+
+    for _, sql in triggers:
+        db.execute(sql)
+
+
+def _upgrade_compact_refdata(db):
+    # Rewrite refdata that was stored in Python's default, padded JSON format.
+    db.create_function("compact_refdata", 1, lambda t: encode_refdata(json.loads(t)))
+
+    with _without_update_triggers(db):
+        db.execute(
+            "UPDATE pubs SET refdata = compact_refdata(refdata) "
+            "WHERE refdata NOT NULL AND refdata != compact_refdata(refdata)"
+        )
+
+
+def _upgrade_add_journals(db):
+    # Journal names are interned in their own table, which also holds their
+    # LaTeX forms so that BibTeX rendering doesn't have to recompute them for
+    # every pub. The names in the refdata remain authoritative: the journalid
+    # column is kept in sync with them.
+    _execute_script(
+        db,
+        """
+CREATE TABLE journals (
+       id INTEGER PRIMARY KEY,
+       name TEXT UNIQUE NOT NULL, /* as it appears in the refdata */
+       issn TEXT, /* the one most commonly seen with this name */
+       latex BLOB NOT NULL /* unicode_to_latex(name) */
+);
+
+ALTER TABLE pubs ADD COLUMN journalid INTEGER REFERENCES journals(id);
+CREATE INDEX pubs_journalid ON pubs(journalid);
+""",
+    )
+
+    from .unicode_to_latex import unicode_to_latex
+
+    best = {}
+
+    for name, issn, n in db.execute(
+        "SELECT json_extract(refdata, '$.journal') AS j, "
+        "  json_extract(refdata, '$.issn') AS i, count(*) "
+        "FROM pubs WHERE typeof(j) == 'text' GROUP BY j, i"
+    ):
+        if not isinstance(issn, str):
+            issn = None
+        # Prefer known ISSNs, then common ones, then break ties consistently.
+        key = (issn is not None, n, issn or "")
+        if name not in best or key > best[name][0]:
+            best[name] = (key, issn)
+
+    db.executemany(
+        "INSERT INTO journals (name, issn, latex) VALUES (?, ?, ?)",
+        ((name, issn, unicode_to_latex(name)) for name, (_, issn) in best.items()),
+    )
+
+    with _without_update_triggers(db):
+        db.execute(
+            "UPDATE pubs SET journalid = (SELECT j.id FROM journals AS j "
+            "  WHERE j.name == json_extract(pubs.refdata, '$.journal')) "
+            "WHERE typeof(json_extract(refdata, '$.journal')) == 'text'"
+        )
+
+
+def _upgrade_keep_deleted_revisions(db):
+    # SQLite can hand a deleted pub's id to the next pub inserted, and if that
+    # started again from revision 0, it would look to the BibTeX caches just
+    # like the deleted one. So instead of forgetting the revision of a deleted
+    # pub, bump it, and a new pub that gets its id carries on from there.
+    _execute_script(
+        db,
+        """
+DROP TRIGGER pubs_delete_revision;
+
+CREATE TRIGGER pubs_delete_revision AFTER DELETE ON pubs BEGIN
+       INSERT OR REPLACE INTO revisions VALUES (old.id,
+              ifnull((SELECT rev FROM revisions WHERE pubid == old.id), 0) + 1);
+       DELETE FROM bibtex_cache WHERE pubid == old.id;
+END;
+""",
+    )
+
+
+def _upgrade_author_name_ids(db):
+    # Pubs refer to author names by their rowids, which VACUUM is free to
+    # renumber unless the table declares them as an INTEGER PRIMARY KEY. So
+    # rebuild the table with one, keeping the existing numbers.
+    _execute_script(
+        db,
+        """
+CREATE TABLE author_names_new (
+       id INTEGER PRIMARY KEY,
+       name TEXT UNIQUE NOT NULL,
+       given TEXT,
+       family TEXT,
+       nsurname TEXT /* normalize_surname(family) */
+);
+
+INSERT INTO author_names_new
+       SELECT oid, name, given, family, nsurname FROM author_names;
+
+DROP TABLE author_names;
+ALTER TABLE author_names_new RENAME TO author_names;
+CREATE INDEX author_names_nsurname ON author_names(nsurname);
+""",
+    )
+
+
+_upgrades = [
+    _upgrade_add_bibtex_cache,
+    _upgrade_add_refdata_indexes,
+    _upgrade_split_author_names,
+    _upgrade_add_author_indexes,
+    _upgrade_add_truncated_authors,
+    _upgrade_add_pubid_indexes,
+    _upgrade_add_library_revision,
+    _upgrade_compact_refdata,
+    _upgrade_add_journals,
+    _upgrade_keep_deleted_revisions,
+    _upgrade_author_name_ids,
+]
+
+SCHEMA_VERSION = len(_upgrades)
+
+
 PubRow = collections.namedtuple(
-    "PubRow", "id abstract arxiv bibcode doi keep nfas " "refdata title year".split()
+    "PubRow",
+    "id abstract arxiv bibcode doi keep nfas " "refdata title year journalid".split(),
 )
 
-AuthorNameRow = collections.namedtuple("AuthorNameRow", ["name"])
+AuthorNameRow = collections.namedtuple(
+    "AuthorNameRow", "name given family nsurname".split()
+)
 
 AuthorRow = collections.namedtuple("AuthorRow", "type pubid idx authid".split())
 
@@ -54,19 +405,204 @@ NicknameRow = collections.namedtuple("NicknameRow", "nickname pubid".split())
 PdfRow = collections.namedtuple("PdfRow", "sha1 pubid".split())
 
 authtypes = {"author": 0, "editor": 1}
+authtype_names = dict((v, k) for k, v in authtypes.items())
 histactions = {"read": 1, "visit": 2}
 
 
+# sqlite3 keeps compiled statements in a per-connection cache keyed on their
+# SQL text. The default size is small enough that a long-running "bib serve"
+# cycles through it, so make room for every fixed statement that we use.
+_statement_cache_size = 512
+
+# Pub queries that get used all over the place, by name, so that their SQL is
+# always the same text and only gets compiled once per connection.
+_pub_statements = {
+    "all": "SELECT * FROM pubs ORDER BY nfas ASC, year ASC",
+    "group": "SELECT p.* FROM pubs AS p, publists AS pl "
+    "WHERE p.id == pl.pubid AND pl.name == ? ORDER BY pl.idx",
+    "id": "SELECT * FROM pubs WHERE id == ?",
+    "recent": "SELECT DISTINCT p.* FROM pubs AS p, history AS h "
+    "WHERE p.id == h.pubid ORDER BY date DESC LIMIT ?",
+}
+
+_tuple_new = tuple.__new__
+
+
+def _pub_row_factory(cursor, row):
+    # Skips the argument unpacking of PubRow(*row), which adds up when listing
+    # the whole library.
+    return _tuple_new(PubRow, row)
+
+
+# Maps keys in the "db" section of the configuration to SQLite pragmas and
+# their allowed values, or None for integers.
+_pragma_settings = [
+    # This goes first so that it applies to changing the journal mode, which
+    # needs a lock.
+    ("busy-timeout", "busy_timeout", None),
+    (
+        "journal-mode",
+        "journal_mode",
+        frozenset("delete truncate persist memory wal off".split()),
+    ),
+    ("synchronous", "synchronous", frozenset("off normal full extra".split())),
+    ("cache-size", "cache_size", None),
+    ("mmap-size", "mmap_size", None),
+    ("temp-store", "temp_store", frozenset("default file memory".split())),
+]
+
+
+def is_busy_error(e):
+    """Whether `e` is SQLite telling us that another process holds a lock that
+    we need."""
+    return isinstance(e, sqlite3.OperationalError) and (
+        "locked" in str(e) or "busy" in str(e)
+    )
+
+
+_collab_re = re.compile(r"\b(collaboration|consortium|team)\b", re.IGNORECASE)
+
+
+def _find_collaboration(names):
+    for name in names:
+        if _collab_re.search(name.replace("_", " ")) is not None:
+            return name
+    return None
+
+
 def nt_augment(ntclass, **vals):
     for k in vals.keys():
         if k not in ntclass._fields:
             raise ValueError(
                 'illegal field "%s" for creating %s instance' % (k, ntclass.__name__)
             )
-    return ntclass(*tuple(vals.get(k) for k in ntclass._fields))
+    return ntclass._make(map(vals.get, ntclass._fields))
+
+
+class PubBatch(object):
+    """A batch of PubRows along with what the bulk operations need to know
+    about them from the other tables. Each table is read with one query for
+    the whole batch, and the results are kept by column: `names` maps a pubid
+    to its `(authors, editors)` lists of encoded names, `nicknames` to a list,
+    and `truncated` to a dict like `get_pub_truncations()`, but with lists.
+    `pdfs` and `lists` are None unless the batch was loaded for a backup.
+    Pubs with no entries in a table don't appear in its dict."""
+
+    __slots__ = "pubs names nicknames truncated pdfs lists".split()
+
+    def __init__(self, pubs):
+        self.pubs = pubs
+        self.names = {}
+        self.nicknames = {}
+        self.truncated = {}
+        self.pdfs = None
+        self.lists = None
 
 
 class BibDB(sqlite3.Connection):
+    max_authors = None
+
+    def configure(self, cfg):
+        """Apply the settings in the "db" section of the configuration."""
+
+        self.max_authors = cfg.getint("db", "max-authors") or None
+
+        for key, pragma, choices in _pragma_settings:
+            value = cfg.get("db", key, fallback="").strip().lower()
+            if not len(value):
+                continue
+
+            if choices is None:
+                try:
+                    value = str(int(value))
+                except ValueError:
+                    die(
+                        'configuration key db/%s must be an integer; got "%s"',
+                        key,
+                        value,
+                    )
+            elif value not in choices:
+                die(
+                    'configuration key db/%s must be one of %s; got "%s"',
+                    key,
+                    ", ".join(sorted(choices)),
+                    value,
+                )
+
+            self.execute("PRAGMA %s = %s" % (pragma, value))
+
+    def upgrade_schema(self):
+        if self.getfirstval("PRAGMA user_version") >= SCHEMA_VERSION:
+            return
+
+        if not self.getfirstval(
+            "SELECT count(*) FROM sqlite_master WHERE name == 'pubs'"
+        ):
+            return  # empty database that "bib init" hasn't filled in yet
+
+        while True:
+            with self.write_transaction():
+                # Another process may have done the work while we waited for
+                # the lock.
+                version = self.getfirstval("PRAGMA user_version")
+                if version >= SCHEMA_VERSION:
+                    return
+
+                try:
+                    _upgrades[version](self)
+                except Exception as e:
+                    die(
+                        "cannot upgrade the database schema to version %d: %s",
+                        version + 1,
+                        e,
+                    )
+
+                self.execute("PRAGMA user_version = %d" % (version + 1))
+
+    @contextlib.contextmanager
+    def write_transaction(self, attempts=5, wait=True):
+        """Run a short transaction that writes to the database.
+
+        Any transaction already in progress is committed first. We then take
+        the write lock up front with BEGIN IMMEDIATE, so that the busy
+        timeout applies to getting it. (If we started by reading, another
+        process could sneak in a write, and then SQLite would fail our own
+        write immediately rather than wait.) If the timeout runs out, we back
+        off and retry a few times before giving up.
+
+        If `wait` is false, we don't wait for the lock at all: each attempt
+        fails right away if another process holds it.
+
+        """
+        import random, time
+
+        self.commit()
+
+        if not wait:
+            timeout = self.getfirstval("PRAGMA busy_timeout")
+            self.execute("PRAGMA busy_timeout = 0")
+
+        try:
+            for i in range(attempts):
+                try:
+                    self.execute("BEGIN IMMEDIATE")
+                    break
+                except sqlite3.OperationalError as e:
+                    if not is_busy_error(e) or i == attempts - 1:
+                        raise
+                    time.sleep(random.uniform(0.1, 0.5) * 2**i)
+        finally:
+            if not wait:
+                self.execute("PRAGMA busy_timeout = %d" % timeout)
+
+        try:
+            yield self
+        except:
+            self.rollback()
+            raise
+
+        self.commit()
+
     def getfirst(self, fmt, *args):
         """Returns the tuple from sqlite3, or None."""
         return self.execute(fmt, args).fetchone()
@@ -81,42 +617,409 @@ class BibDB(sqlite3.Connection):
 
     def pub_fquery(self, q, *args):
         c = self.cursor()
-        c.row_factory = lambda curs, tup: PubRow(*tup)
+        c.row_factory = _pub_row_factory
         return c.execute(q, args)
 
     def pub_query(self, partial, *args):
         return self.pub_fquery("SELECT * FROM pubs WHERE " + partial, *args)
 
-    def learn_pub_authors(self, pubid, authtype, authors):
-        authtype = authtypes[authtype]
-        c = self.cursor()
+    def pub_named_query(self, name, *args):
+        """Run one of the canned pub queries in `_pub_statements`, returning a
+        cursor that yields PubRows. Prefer these to pub_query() in anything
+        that runs a lot."""
+        return self.pub_fquery(_pub_statements[name], *args)
+
+    def _refdata_expr(self, field):
+        # The path has to be a literal, not a parameter, for the expression
+        # indexes to apply.
+        if not field.isidentifier():
+            raise ValueError("illegal refdata field name %r" % field)
+        return "json_extract(refdata, '$.%s')" % field
+
+    def canonicalize_journal(self, oldjournal, newjournal, newissn=None):
+        """Rename a journal throughout the refdata, adding an ISSN to records
+        that lack one if `newissn` is given. Returns the number of pubs
+        changed. The revision triggers take care of the BibTeX cache."""
+
+        journalid = self.intern_journal(
+            newjournal,
+            newissn
+            or self.getfirstval(
+                "SELECT issn FROM journals WHERE name == ?", oldjournal
+            ),
+        )
 
-        for idx, auth in enumerate(authors):
-            # Based on reading StackExchange, there's no cleaner way to do this,
-            # but the SELECT should be snappy.
-            c.execute("INSERT OR IGNORE INTO author_names VALUES (?)", (auth,))
-            row = self.getfirst("SELECT oid FROM author_names WHERE name = ?", auth)[0]
-            c.execute(
-                "INSERT OR REPLACE INTO authors VALUES (?, ?, ?, ?)",
-                (authtype, pubid, idx, row),
+        return self.execute(
+            "UPDATE pubs SET journalid = ?4, refdata = "
+            "  CASE WHEN ?3 IS NULL THEN json_set(refdata, '$.journal', ?2) "
+            "  ELSE json_insert(json_set(refdata, '$.journal', ?2), '$.issn', ?3) END "
+            "WHERE %s == ?1" % self._refdata_expr("journal"),
+            (oldjournal, newjournal, newissn, journalid),
+        ).rowcount
+
+    def intern_journal(self, name, issn=None):
+        """Returns the ID of the journal named `name`, adding it to the journals
+        table if needed. Returns None if `name` isn't a string, which is
+        convenient for dealing with refdata. If the journal doesn't have an
+        ISSN yet and `issn` is given, it's recorded."""
+
+        if not isinstance(name, str):
+            return None
+
+        if not isinstance(issn, str):
+            issn = None
+
+        row = self.getfirst("SELECT id, issn FROM journals WHERE name == ?", name)
+
+        if row is None:
+            from .unicode_to_latex import unicode_to_latex
+
+            return self.execute(
+                "INSERT INTO journals (name, issn, latex) VALUES (?, ?, ?)",
+                (name, issn, unicode_to_latex(name)),
+            ).lastrowid
+
+        if row[1] is None and issn is not None:
+            self.execute("UPDATE journals SET issn = ? WHERE id == ?", (issn, row[0]))
+
+        return row[0]
+
+    def get_journal_latex(self, journalids):
+        """Returns a dict mapping each of `journalids` to the LaTeX form of the
+        journal's name. None is ignored."""
+
+        with self._temp_table_read(
+            "wanted_journalids", (j for j in journalids if j is not None)
+        ):
+            return dict(
+                (jid, bytes(latex))
+                for jid, latex in self.execute(
+                    "SELECT j.id, j.latex FROM temp.wanted_journalids AS w, "
+                    "  journals AS j WHERE j.id == w.value"
+                )
             )
 
+    def _fill_temp_table(self, name, values):
+        """Load `values` into a one-column temporary table for use in joins. This
+        lets us resolve many keys with one query rather than one query apiece.
+
+        """
+        self.execute("CREATE TEMP TABLE IF NOT EXISTS %s (value PRIMARY KEY)" % name)
+        self.execute("DELETE FROM temp.%s" % name)
+        self.executemany(
+            "INSERT OR IGNORE INTO temp.%s VALUES (?)" % name, ((v,) for v in values)
+        )
+
+    @contextlib.contextmanager
+    def _temp_table_read(self, name, values):
+        """Fill the temporary table `name` with `values`, for a read-only query
+        that joins against it. Filling the table implicitly begins a
+        transaction, and if that stayed open, its stale snapshot would make
+        our next write fail at once with "database is locked" whenever
+        another process had written in the meantime. So unless a transaction
+        was already in progress, we end it when the block exits. Fetch the
+        results inside the block.
+
+        """
+        began = not self.in_transaction
+        self._fill_temp_table(name, values)
+
+        try:
+            yield
+        finally:
+            if began:
+                self.commit()
+
+    def locate_nicknames(self, nicknames):
+        """Returns a dict mapping each of `nicknames` that is known to the
+        database to its PubRow. Unknown nicknames are just left out."""
+
+        with self._temp_table_read("wanted_nicks", nicknames):
+            return dict(
+                (t[0], _tuple_new(PubRow, t[1:]))
+                for t in self.execute(
+                    "SELECT n.nickname, p.* FROM temp.wanted_nicks AS w, "
+                    "  nicknames AS n, pubs AS p "
+                    "WHERE n.nickname == w.value AND p.id == n.pubid"
+                )
+            )
+
+    def locate_pub_refs(self, kind, keys):
+        """Resolve many pub references of one kind, as classified by
+        `bibcore.classify_pub_ref()`, with a single join. For "lastlisting",
+        the keys are zero-based integer indices. Returns a dict mapping each
+        key that matched anything to a list of its PubRows; unmatched keys are
+        left out."""
+
+        if kind in ("arxiv", "bibcode", "doi"):
+            sql = (
+                "SELECT w.value, p.* FROM temp.wanted_refs AS w, pubs AS p "
+                "WHERE p.%s == w.value" % kind
+            )
+        elif kind == "nickname":
+            sql = (
+                "SELECT w.value, p.* FROM temp.wanted_refs AS w, "
+                "  nicknames AS n, pubs AS p "
+                "WHERE n.nickname == w.value AND p.id == n.pubid"
+            )
+        elif kind == "lastlisting":
+            sql = (
+                "SELECT w.value, p.* FROM temp.wanted_refs AS w, "
+                "  publists AS pl, pubs AS p "
+                "WHERE pl.name == 'last_listing' AND pl.idx == w.value "
+                "AND p.id == pl.pubid"
+            )
+        elif kind == "nfasy":
+            # Keys are "nfas.year" or "nfas.*". Pull in everything for the
+            # surnames and sort out the years here.
+            years = {}
+            for key in keys:
+                nfas, year = key.rsplit(".", 1)
+                years.setdefault(nfas, []).append(year)
+
+            keys = years.keys()
+            sql = (
+                "SELECT w.value, p.* FROM temp.wanted_refs AS w, pubs AS p "
+                "WHERE p.nfas == w.value"
+            )
+        else:
+            raise ValueError("unrecognized pub reference kind %r" % kind)
+
+        result = {}
+
+        with self._temp_table_read("wanted_refs", keys):
+            for t in self.execute(sql):
+                pub = _tuple_new(PubRow, t[1:])
+
+                if kind != "nfasy":
+                    result.setdefault(t[0], []).append(pub)
+                    continue
+
+                for year in years[t[0]]:
+                    if year == "*" or pub.year == int(year):
+                        result.setdefault(t[0] + "." + year, []).append(pub)
+
+        return result
+
+    def _get_wanted_authors(self):
+        """Returns a dict mapping the pubids in the "wanted_pubids" temporary table
+        to tuples of `(authors, editors)`, where each item is a list of
+        encoded names in order. Pubs without any authors or editors are left
+        out.
+
+        """
+        result = {}
+
+        for pubid, authtype, name in self.execute(
+            "SELECT au.pubid, au.type, an.name "
+            "FROM temp.wanted_pubids AS w, authors AS au, author_names AS an "
+            "WHERE au.pubid == w.value AND au.authid == an.oid "
+            "ORDER BY au.pubid, au.type, au.idx"
+        ):
+            names = result.get(pubid)
+            if names is None:
+                names = result[pubid] = ([], [])
+            # This relies on the values in `authtypes`.
+            names[authtype].append(name)
+
+        return result
+
+    def library_revision(self):
+        """Returns a number that increases whenever the pubs, PDFs, or reading
+        history of the library change."""
+        return self.getfirstval("SELECT rev FROM library_revision")
+
+    def get_pub_revisions(self, pubids):
+        """Returns a dict mapping each of `pubids` to its revision number, which
+        increases every time that the pub's record is modified."""
+
+        revs = dict.fromkeys(pubids, 0)
+
+        with self._temp_table_read("wanted_pubids", revs.keys()):
+            for pubid, rev in self.execute(
+                "SELECT r.pubid, r.rev FROM temp.wanted_pubids AS w, revisions AS r "
+                "WHERE r.pubid == w.value"
+            ):
+                revs[pubid] = rev
+
+        return revs
+
+    def get_cached_bibtex(self, style, pubids):
+        """Returns a dict mapping `(pubid, nickname)` to rendered BibTeX for
+        those of `pubids` with up-to-date entries in the cache for `style`."""
+
+        with self._temp_table_read("wanted_pubids", pubids):
+            return dict(
+                ((pubid, nick), bytes(data))
+                for pubid, nick, data in self.execute(
+                    "SELECT c.pubid, c.nickname, c.bibtex "
+                    "FROM temp.wanted_pubids AS w, bibtex_cache AS c "
+                    "  LEFT JOIN revisions AS r ON r.pubid == c.pubid "
+                    "WHERE c.pubid == w.value AND c.style == ? "
+                    "  AND c.rev == ifnull(r.rev, 0)",
+                    (style,),
+                )
+            )
+
+    def cache_bibtex(self, style, entries):
+        """`entries` is a sequence of `(pubid, nickname, bibtex)`. The style may
+        be given as "name@fingerprint", in which case these entries replace
+        any with other fingerprints for the same style. The cache is only an
+        optimization, so if another process is hogging the database, we just
+        skip it."""
+
+        entries = list(entries)
+        basename = style.split("@", 1)[0]
+
+        try:
+            with self.write_transaction(attempts=1, wait=False):
+                revs = self.get_pub_revisions(set(e[0] for e in entries))
+
+                self.executemany(
+                    "DELETE FROM bibtex_cache WHERE pubid == ? AND nickname == ? "
+                    "AND (style == ? OR style GLOB ?) AND style != ?",
+                    (
+                        (pubid, nick, basename, basename + "@*", style)
+                        for pubid, nick, _ in entries
+                    ),
+                )
+                self.executemany(
+                    "INSERT OR REPLACE INTO bibtex_cache VALUES (?, ?, ?, ?, ?)",
+                    (
+                        (pubid, style, nick, revs[pubid], data)
+                        for pubid, nick, data in entries
+                    ),
+                )
+        except sqlite3.OperationalError as e:
+            if not is_busy_error(e):
+                raise
+
+    def learn_pub_authors(self, pubid, authtype, authors, total=None, collab=None):
+        """If the "max-authors" setting is in effect and there are more authors
+        than that, we only store the first few, along with the total and the
+        name of the collaboration, if any. `total` and `collab` are for
+        recording a list that has already been truncated."""
+
+        authtypeid = authtypes[authtype]
+        authors = list(authors)
+
+        if total is None:
+            total = len(authors)
+
+        if self.max_authors is not None and len(authors) > self.max_authors:
+            if collab is None:
+                collab = _find_collaboration(authors)
+            authors = authors[: self.max_authors]
+
+        parsed = parse_names(authors)
+        self.executemany(
+            "INSERT OR IGNORE INTO author_names (name, given, family, nsurname) "
+            "VALUES (?, ?, ?, ?)",
+            (
+                (auth, given, family, nsurname)
+                for auth, (given, family), nsurname in zip(
+                    authors, parsed, normalize_surnames(p[1] for p in parsed)
+                )
+            ),
+        )
+
+        self._fill_temp_table("wanted_names", authors)
+        oids = dict(
+            self.execute(
+                "SELECT an.name, an.oid FROM temp.wanted_names AS w, author_names AS an "
+                "WHERE an.name == w.value"
+            )
+        )
+
+        self.executemany(
+            "INSERT OR REPLACE INTO authors VALUES (?, ?, ?, ?)",
+            ((authtypeid, pubid, idx, oids[auth]) for idx, auth in enumerate(authors)),
+        )
+
+        if total > len(authors):
+            self.execute(
+                "INSERT OR REPLACE INTO truncated_authors VALUES (?, ?, ?, ?)",
+                (pubid, authtypeid, total, collab),
+            )
+
+    def get_pub_truncations(self, pubid):
+        """Returns a dict mapping "author" and/or "editor" to `(total, collab)`
+        for the author lists of this pub that have been truncated."""
+
+        return dict(
+            (authtype_names[t[0]], t[1:])
+            for t in self.execute(
+                "SELECT type, total, collab FROM truncated_authors WHERE pubid == ?",
+                (pubid,),
+            )
+        )
+
     def get_pub_authors(self, pubid, authtype="author"):
         authtype = authtypes[authtype]
 
-        return (
-            parse_name(a[0])
-            for a in self.execute(
-                "SELECT name FROM authors AS au, author_names AS an "
-                "WHERE au.type == ? AND au.authid == an.oid "
-                "  AND au.pubid == ? "
-                "ORDER BY idx",
-                (
-                    authtype,
-                    pubid,
-                ),
+        return self.execute(
+            "SELECT an.given, an.family FROM authors AS au, author_names AS an "
+            "WHERE au.type == ? AND au.authid == an.oid "
+            "  AND au.pubid == ? "
+            "ORDER BY idx",
+            (
+                authtype,
+                pubid,
+            ),
+        ).fetchall()
+
+    def get_author_names(self, authids):
+        """Returns a dict mapping each of the author IDs `authids` to its encoded
+        name."""
+
+        with self._temp_table_read("wanted_authids", authids):
+            return dict(
+                self.execute(
+                    "SELECT an.oid, an.name FROM temp.wanted_authids AS w, "
+                    "  author_names AS an WHERE an.oid == w.value"
+                )
             )
-        )
+
+    def locate_author_ids(self, surname, initials=None):
+        """Returns a list of the IDs of the author names whose surname normalizes
+        like `surname` and, if `initials` is given, e.g. "PK", whose initials
+        start with those letters."""
+
+        authids = []
+
+        for oid, given in self.execute(
+            "SELECT oid, given FROM author_names WHERE nsurname == ?",
+            (normalize_surname(surname),),
+        ):
+            if initials is None or name_initials(given).startswith(initials):
+                authids.append(oid)
+
+        return authids
+
+    def locate_pubs_by_id(self, pubids):
+        """Returns a list of the PubRows with the IDs `pubids`, in order of ID.
+        Unknown IDs are skipped."""
+
+        with self._temp_table_read("wanted_pubids", pubids):
+            return self.pub_fquery(
+                "SELECT p.* FROM temp.wanted_pubids AS w, pubs AS p "
+                "WHERE p.id == w.value ORDER BY p.id"
+            ).fetchall()
+
+    def locate_author_pubs(self, surname, initials=None):
+        """Find pubs with an author, in any position, whose surname normalizes
+        like `surname`. If `initials` is given, e.g. "PK", the author's
+        initials must start with those letters. Returns a list of PubRows."""
+
+        with self._temp_table_read(
+            "wanted_authids", self.locate_author_ids(surname, initials)
+        ):
+            return self.pub_fquery(
+                "SELECT p.* FROM pubs AS p WHERE p.id IN ("
+                "  SELECT au.pubid FROM temp.wanted_authids AS w, authors AS au "
+                "  WHERE au.authid == w.value AND au.type == ?)",
+                authtypes["author"],
+            ).fetchall()
 
     def get_pub_fas(self, pubid):
         """FAS = first-author surname. May return None. We specifically are retrieving
@@ -124,7 +1027,7 @@ class BibDB(sqlite3.Connection):
         the 'pubs' table."""
 
         for t in self.execute(
-            "SELECT name FROM authors AS au, author_names AS an "
+            "SELECT an.family FROM authors AS au, author_names AS an "
             "WHERE au.type == ? AND au.authid == an.oid "
             "  AND au.pubid == ? "
             "AND idx == 0",
@@ -133,7 +1036,7 @@ class BibDB(sqlite3.Connection):
                 pubid,
             ),
         ):
-            return parse_name(t[0])[1]
+            return t[0]
 
         return None
 
@@ -169,6 +1072,7 @@ class BibDB(sqlite3.Connection):
         authors = info.pop("authors", ())
         editors = info.pop("editors", ())
         nicknames = info.pop("nicknames", ())
+        truncated = info.pop("truncated", {})
 
         if "abstract" in info:
             info["abstract"] = squish_spaces(info["abstract"])
@@ -180,7 +1084,11 @@ class BibDB(sqlite3.Connection):
 
         if "refdata" in info:
             self._lint_refdata(info)
-            info["refdata"] = json.dumps(info["refdata"])
+            rd = info["refdata"]
+            info["journalid"] = self.intern_journal(rd.get("journal"), rd.get("issn"))
+            info["refdata"] = encode_refdata(rd)
+        else:
+            info["journalid"] = None
 
         row = nt_augment(PubRow, **info)
         c = self.cursor()
@@ -189,19 +1097,23 @@ class BibDB(sqlite3.Connection):
             # not elegant but as far as I can tell there's no alternative.
             c.execute(
                 "UPDATE pubs SET abstract=?, arxiv=?, bibcode=?, "
-                "  doi=?, keep=?, nfas=?, refdata=?, title=?, year=? "
+                "  doi=?, keep=?, nfas=?, refdata=?, title=?, year=?, journalid=? "
                 "WHERE id == ?",
                 row[1:] + (pubid,),
             )
         else:
-            c.execute("INSERT INTO pubs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            c.execute("INSERT INTO pubs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
             pubid = c.lastrowid
 
         if authors:
-            self.learn_pub_authors(pubid, "author", authors)
+            self.learn_pub_authors(
+                pubid, "author", authors, *truncated.get("author", ())
+            )
 
         if editors:
-            self.learn_pub_authors(pubid, "editor", editors)
+            self.learn_pub_authors(
+                pubid, "editor", editors, *truncated.get("editor", ())
+            )
 
         if nicknames:
             for nickname in nicknames:
@@ -222,6 +1134,7 @@ class BibDB(sqlite3.Connection):
         info["keep"] = pub.keep
 
         self.execute("DELETE FROM authors WHERE pubid == ?", (pub.id,))
+        self.execute("DELETE FROM truncated_authors WHERE pubid == ?", (pub.id,))
         self.execute("DELETE FROM nicknames WHERE pubid == ?", (pub.id,))
         # XXX later maybe:
         # self.execute ('DELETE FROM notes WHERE pubid == ?', (pub.id, ))
@@ -235,6 +1148,7 @@ class BibDB(sqlite3.Connection):
             warn("orphaning file %s", libpath(sha1, "pdf"))
 
         self.execute("DELETE FROM authors WHERE pubid == ?", (pubid,))
+        self.execute("DELETE FROM truncated_authors WHERE pubid == ?", (pubid,))
         self.execute("DELETE FROM history WHERE pubid == ?", (pubid,))
         self.execute("DELETE FROM nicknames WHERE pubid == ?", (pubid,))
         self.execute("DELETE FROM notes WHERE pubid == ?", (pubid,))
@@ -242,40 +1156,198 @@ class BibDB(sqlite3.Connection):
         self.execute("DELETE FROM publists WHERE pubid == ?", (pubid,))
         self.execute("DELETE FROM pubs WHERE id == ?", (pubid,))
 
-        # at some point the author_names table will need rebuilding, but
-        # I don't think we should worry about that here.
+        # This may leave orphaned entries in author_names, but "bib gc"
+        # takes care of those.
 
     def jsonify_pub(self, pubid):
         """The data structure here should be, to the best of our effort, compatible
         with the one accepted by learn_pub().
 
         """
-        pub = self.pub_query("id == ?", pubid).fetchone()
+        pub = self.pub_named_query("id", pubid).fetchone()
+        return next(self.jsonify_pubs([pub]))
 
-        info = {}
-        info["authors"] = [
-            encode_name(*n) for n in self.get_pub_authors(pubid, "author")
-        ]
-        info["editors"] = [
-            encode_name(*n) for n in self.get_pub_authors(pubid, "editor")
-        ]
-        info["abstract"] = pub.abstract
-        info["title"] = pub.title
-        info["arxiv"] = pub.arxiv
-        info["bibcode"] = pub.bibcode
-        info["doi"] = pub.doi
-        info["year"] = pub.year
-        info["nicknames"] = list(
-            self.execute("SELECT nickname FROM nicknames " "WHERE pubid == ?", (pubid,))
+    def jsonify_pubs(self, pubs):
+        """Like jsonify_pub(), but for a sequence of PubRows, yielding one info
+        dict for each of them in order. The pubs are loaded in batches with
+        pub_batches(), so this is the way to go when dealing with a lot of
+        pubs.
+
+        """
+        for batch in self.pub_batches(pubs):
+            for pub in batch.pubs:
+                info = {}
+                info["authors"], info["editors"] = batch.names.get(pub.id, ([], []))
+                info["abstract"] = pub.abstract
+                info["title"] = pub.title
+                info["arxiv"] = pub.arxiv
+                info["bibcode"] = pub.bibcode
+                info["doi"] = pub.doi
+                info["year"] = pub.year
+                info["nicknames"] = batch.nicknames.get(pub.id, [])
+                info["refdata"] = decode_refdata(pub.refdata)
+                if pub.id in batch.truncated:
+                    info["truncated"] = batch.truncated[pub.id]
+                yield info
+
+    def load_pub_batch(self, pubs, backup=False):
+        """Returns a PubBatch for the sequence of PubRows `pubs`. If `backup` is
+        true, the PDFs and list memberships of the pubs are loaded as well."""
+
+        batch = PubBatch(list(pubs))
+
+        with self._temp_table_read("wanted_pubids", (p.id for p in batch.pubs)):
+            batch.names = self._get_wanted_authors()
+
+            for nickname, pubid in self.execute(
+                "SELECT n.nickname, n.pubid FROM temp.wanted_pubids AS w, "
+                "  nicknames AS n WHERE n.pubid == w.value"
+            ):
+                batch.nicknames.setdefault(pubid, []).append(nickname)
+
+            for pubid, authtype, total, collab in self.execute(
+                "SELECT t.pubid, t.type, t.total, t.collab "
+                "FROM temp.wanted_pubids AS w, truncated_authors AS t "
+                "WHERE t.pubid == w.value"
+            ):
+                batch.truncated.setdefault(pubid, {})[authtype_names[authtype]] = [
+                    total,
+                    collab,
+                ]
+
+            if backup:
+                batch.pdfs = {}
+                for pubid, sha1 in self.execute(
+                    "SELECT p.pubid, p.sha1 FROM temp.wanted_pubids AS w, pdfs AS p "
+                    "WHERE p.pubid == w.value ORDER BY p.rowid"
+                ):
+                    batch.pdfs.setdefault(pubid, []).append(sha1)
+
+                batch.lists = {}
+                for pubid, name, idx in self.execute(
+                    "SELECT pl.pubid, pl.name, pl.idx "
+                    "FROM temp.wanted_pubids AS w, publists AS pl "
+                    "WHERE pl.pubid == w.value ORDER BY pl.rowid"
+                ):
+                    batch.lists.setdefault(pubid, []).append((name, idx))
+
+        return batch
+
+    def pub_batches(self, pubs, batchsize=1000, backup=False):
+        """Split the iterable of PubRows `pubs` into groups of `batchsize` and
+        yield a PubBatch for each group. Memory use stays flat however many
+        pubs there are, and the other tables get one query per batch rather
+        than one per pub. `pubs` can be a cursor from pub_fquery() and
+        friends."""
+
+        chunk = []
+
+        for pub in pubs:
+            chunk.append(pub)
+            if len(chunk) == batchsize:
+                yield self.load_pub_batch(chunk, backup)
+                chunk = []
+
+        if len(chunk):
+            yield self.load_pub_batch(chunk, backup)
+
+    # Maintenance. The tables keyed on pubs, and the sort of stray row that
+    # can be left behind in them. The revisions of deleted pubs are kept on
+    # purpose; see _upgrade_keep_deleted_revisions().
+
+    _pub_tables = (
+        "authors bibtex_cache history nicknames notes pdfs publists "
+        "truncated_authors"
+    ).split()
+
+    # A few core queries, to check whether the planner's choices change.
+    _plan_queries = [
+        (
+            "nickname lookup",
+            "SELECT p.* FROM nicknames AS n, pubs AS p "
+            "WHERE n.nickname == 'x' AND p.id == n.pubid",
+        ),
+        (
+            "authors of a pub",
+            "SELECT an.given, an.family FROM authors AS au, author_names AS an "
+            "WHERE au.type == 0 AND au.authid == an.oid AND au.pubid == 1 "
+            "ORDER BY idx",
+        ),
+        (
+            "pubs by author",
+            "SELECT au.pubid FROM author_names AS an, authors AS au "
+            "WHERE an.nsurname == 'x' AND au.authid == an.oid AND au.type == 0",
+        ),
+        (
+            "pubs by journal",
+            "SELECT id FROM pubs WHERE json_extract(refdata, '$.journal') == 'x'",
+        ),
+        (
+            "recent history",
+            "SELECT DISTINCT p.* FROM pubs AS p, history AS h "
+            "WHERE p.id == h.pubid ORDER BY date DESC LIMIT 10",
+        ),
+    ]
+
+    def collect_garbage(self, history=False):
+        """Delete rows that refer to pubs that no longer exist, and author names
+        and journals that no pub uses. If `history` is true, also collapse the history to
+        the most recent entry for each pub and action. Returns a dict
+        mapping table names to the number of rows deleted."""
+
+        counts = {}
+
+        for table in self._pub_tables:
+            counts[table] = self.execute(
+                "DELETE FROM %s WHERE pubid NOT IN (SELECT id FROM pubs)" % table
+            ).rowcount
+
+        counts["author_names"] = self.execute(
+            "DELETE FROM author_names WHERE oid NOT IN "
+            "(SELECT DISTINCT authid FROM authors)"
+        ).rowcount
+
+        counts["journals"] = self.execute(
+            "DELETE FROM journals WHERE id NOT IN "
+            "(SELECT DISTINCT journalid FROM pubs WHERE journalid NOT NULL)"
+        ).rowcount
+
+        if history:
+            counts["history"] += self.execute(
+                "DELETE FROM history WHERE date NOT IN "
+                "(SELECT max(date) FROM history GROUP BY pubid, action)"
+            ).rowcount
+
+        return counts
+
+    def space_usage(self):
+        """Returns `(total, free)`, the size of the database file and the amount of
+        it that is unused, in bytes."""
+
+        pagesize = self.getfirstval("PRAGMA page_size")
+        return (
+            self.getfirstval("PRAGMA page_count") * pagesize,
+            self.getfirstval("PRAGMA freelist_count") * pagesize,
         )
-        info["refdata"] = json.loads(pub.refdata)
 
-        return info
+    def query_plans(self):
+        """Returns a list of `(description, plan)` for some core queries, where
+        the plan is the text of EXPLAIN QUERY PLAN."""
+
+        return [
+            (desc, "; ".join(t[-1] for t in self.execute("EXPLAIN QUERY PLAN " + q)))
+            for desc, q in self._plan_queries
+        ]
 
     def log_action(self, pubid, actionid):
         import time
 
+        # The date is the primary key, so two actions logged in the same
+        # second -- say, by two bib processes -- would collide. Nudge the later
+        # one forward.
         actionid = histactions[actionid]
         self.execute(
-            "INSERT INTO history VALUES (?, ?, ?)", (int(time.time()), pubid, actionid)
+            "INSERT INTO history VALUES ("
+            "  (SELECT max(?, ifnull(max(date), 0) + 1) FROM history), ?, ?)",
+            (int(time.time()), pubid, actionid),
         )
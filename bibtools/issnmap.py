@@ -0,0 +1,182 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2014-2022 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+"""
+Tables mapping ISSNs to journal names.
+
+The tables are text files with one "ISSN name" pair per line, like
+"apj-issnmap.txt" shipped with this package. A user can add to or override
+the entries of a table by creating a file of the same name in the bib data
+directory.
+
+Rather than parsing the text files every time a style is set up, we compile
+them into little SQLite databases in the "cache" subdirectory of the data
+directory, and recompile when any of the source files change. Lookups then
+only touch the rows that they need, and the compiled file is shared by every
+process through the OS page cache, so even a table covering every journal in
+existence costs next to nothing to "load".
+
+"""
+
+import json
+import os
+import sqlite3
+
+from .util import *
+from .unicode_to_latex import unicode_to_latex
+
+__all__ = "get_issn_map IssnMap".split()
+
+
+def _parse_sources(stamps):
+    for path, mtime, _ in stamps:
+        if mtime is None:
+            continue  # no such file
+
+        with open(path, "rb") as f:
+            for line in f:
+                line = line.split(b"#")[0].strip().decode("utf-8")
+                if not len(line):
+                    continue
+
+                issn, jname = line.split(None, 1)
+                yield issn, jname
+
+
+def _compile(db, stamps):
+    db.executescript(
+        """
+CREATE TABLE stamps (json TEXT NOT NULL);
+CREATE TABLE issnmap (issn TEXT PRIMARY KEY NOT NULL, name TEXT NOT NULL) WITHOUT ROWID;
+"""
+    )
+    # Later sources override earlier ones.
+    db.executemany(
+        "INSERT OR REPLACE INTO issnmap VALUES (?, ?)", _parse_sources(stamps)
+    )
+    db.execute("INSERT INTO stamps VALUES (?)", (json.dumps(stamps),))
+    db.commit()
+
+
+class IssnMap(object):
+    """A read-only mapping from ISSNs to LaTeX-encoded journal names, as bytes.
+    Nothing is read from disk until the first lookup."""
+
+    def __init__(self, name):
+        self.name = name
+        self._db = None
+        self._stamps = None
+        self._memo = {}
+
+    def _sources(self):
+        fn = self.name + "-issnmap.txt"
+        return [os.path.join(os.path.dirname(__file__), fn), bibpath(fn)]
+
+    def _connect(self):
+        if self._db is not None:
+            return self._db
+
+        stamps = file_stamps(self._sources())
+        if all(mtime is None for _, mtime, _ in stamps):
+            raise ValueError('no ISSN map named "%s"' % self.name)
+
+        path = bibpath("cache", self.name + "-issnmap.sqlite3")
+
+        try:
+            db = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+            saved = json.loads(db.execute("SELECT json FROM stamps").fetchone()[0])
+            if saved == [list(s) for s in stamps]:
+                self._db = db
+                self._stamps = stamps
+                return db
+            db.close()
+        except (sqlite3.Error, TypeError, ValueError):
+            pass
+
+        # Need to (re)compile. Do it in a temporary file and rename it into
+        # place so that concurrent processes never see a half-built table.
+        temppath = "%s.%d.tmp" % (path, os.getpid())
+
+        try:
+            mkdir_p(bibpath("cache"))
+            try:
+                os.unlink(temppath)
+            except FileNotFoundError:
+                pass
+            db = sqlite3.connect(temppath)
+            _compile(db, stamps)
+            db.close()
+            os.replace(temppath, path)
+            self._db = sqlite3.connect("file:%s?mode=ro" % path, uri=True)
+        except (OSError, sqlite3.Error) as e:
+            warn("cannot save compiled ISSN map %s: %s", path, e)
+            self._db = sqlite3.connect(":memory:")
+            _compile(self._db, stamps)
+
+        self._stamps = stamps
+        return self._db
+
+    def fingerprint(self):
+        """Returns a short string that changes whenever the source files of the
+        map do, for keying caches of anything rendered with it. If the files
+        have changed since we loaded them, we also forget what we loaded, so
+        that long-running processes pick up the edits."""
+
+        from hashlib import sha1
+
+        stamps = file_stamps(self._sources())
+
+        if self._db is not None and stamps != self._stamps:
+            self._db.close()
+            self._db = None
+            self._memo = {}
+
+        return sha1(json.dumps(stamps).encode("utf8")).hexdigest()[:16]
+
+    def get(self, issn, default=None):
+        v = self._memo.get(issn)
+        if v is not None:
+            return v
+
+        row = (
+            self._connect()
+            .execute("SELECT name FROM issnmap WHERE issn == ?", (issn,))
+            .fetchone()
+        )
+        if row is None:
+            return default
+
+        v = self._memo[issn] = unicode_to_latex(row[0])
+        return v
+
+    def __getitem__(self, issn):
+        v = self.get(issn)
+        if v is None:
+            raise KeyError(issn)
+        return v
+
+    def __contains__(self, issn):
+        return self.get(issn) is not None
+
+    def __len__(self):
+        return self._connect().execute("SELECT count(*) FROM issnmap").fetchone()[0]
+
+    def items(self):
+        for issn, name in self._connect().execute(
+            "SELECT issn, name FROM issnmap ORDER BY issn"
+        ):
+            yield issn, unicode_to_latex(name)
+
+
+_maps = {}
+
+
+def get_issn_map(name):
+    """Get the ISSN map with the given name. Maps are shared within a process,
+    so any number of styles can use the same one for free."""
+
+    m = _maps.get(name)
+    if m is None:
+        m = _maps[name] = IssnMap(name)
+    return m
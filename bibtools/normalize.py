@@ -0,0 +1,250 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2014-2022 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+"""
+Normalization of the free-form reference data ("refdata") of publications.
+
+A normalizer is an object with a `name` and a `__call__(rd)` method that fixes
+up a refdata dictionary in place. It may also have a `prepare(db)` method,
+which is called once before any records are processed and can gather
+statistics from the whole library. Normalizers must still do something
+sensible if they haven't been prepared, since that's how the builtins are
+applied to BibTeX records as they are imported.
+
+Besides the builtins listed below, normalizers can be provided by entry points
+in the "bibtools.normalizers" group, which should resolve to classes or other
+callables returning a normalizer.
+
+"""
+
+import collections
+import re
+
+from .util import *
+from .db import decode_refdata, encode_refdata
+
+__all__ = str(
+    """
+default_normalizers
+get_normalizer
+normalize_library
+normalize_refdata
+"""
+).split()
+
+
+_issn_re = re.compile(r"^\s*(\d{4})\s*-?\s*(\d{3}[\dX])\s*$", re.IGNORECASE)
+_page_range_re = re.compile(r"^\s*([^\s\-–—]+)\s*(?:-+|–|—)\s*(\S+)\s*$")
+
+
+def _clean_issn(issn):
+    m = _issn_re.match(issn)
+    if m is None:
+        return issn
+    return (m.group(1) + "-" + m.group(2)).upper()
+
+
+def _clean_journal(journal):
+    journal = " ".join(journal.split())
+
+    if journal.startswith("{") and journal.endswith("}"):
+        # Only strip the braces if they're matched around the whole name,
+        # not for something like "{A}strophys. {J}".
+        depth = 0
+        for i, c in enumerate(journal):
+            if c == "{":
+                depth += 1
+            elif c == "}":
+                depth -= 1
+                if depth == 0 and i != len(journal) - 1:
+                    break
+        else:
+            journal = journal[1:-1].strip()
+
+    return journal
+
+
+def _journal_issn_counts(db):
+    """Returns a Counter of `(journal, issn)` pairs over the whole library,
+    after basic cleanup of both."""
+
+    counts = collections.Counter()
+
+    for journal, issn, n in db.execute(
+        "SELECT json_extract(refdata, '$.journal') AS j, "
+        "  json_extract(refdata, '$.issn') AS i, count(*) "
+        "FROM pubs WHERE j NOT NULL AND i NOT NULL GROUP BY j, i"
+    ):
+        counts[(_clean_journal(str(journal)), _clean_issn(str(issn)))] += n
+
+    return counts
+
+
+def _most_common_by(counts, keyidx):
+    best = {}
+
+    for pair, n in counts.items():
+        key = pair[keyidx]
+        cur = best.get(key)
+        # Break ties deterministically.
+        if cur is None or (n, pair[1 - keyidx]) > cur:
+            best[key] = (n, pair[1 - keyidx])
+
+    return dict((k, v[1]) for k, v in best.items())
+
+
+class IssnNormalizer(object):
+    """Tidy up the formatting of ISSNs ("00046361" becomes "0004-6361"). If
+    prepared with a database, also fill in missing ISSNs from other records
+    that have the same journal name."""
+
+    name = "issn"
+
+    def __init__(self):
+        self.issn_for_journal = {}
+
+    def prepare(self, db):
+        self.issn_for_journal = _most_common_by(_journal_issn_counts(db), 0)
+
+    def __call__(self, rd):
+        issn = rd.get("issn")
+
+        if isinstance(issn, str):
+            rd["issn"] = _clean_issn(issn)
+        elif issn is None and isinstance(rd.get("journal"), str):
+            issn = self.issn_for_journal.get(_clean_journal(rd["journal"]))
+            if issn is not None:
+                rd["issn"] = issn
+
+
+class JournalNormalizer(object):
+    """Tidy up whitespace and stray braces in journal names. If prepared with a
+    database, also replace each journal name with the one most commonly used
+    in the library for the same ISSN."""
+
+    name = "journal"
+
+    def __init__(self):
+        self.journal_for_issn = {}
+
+    def prepare(self, db):
+        self.journal_for_issn = _most_common_by(_journal_issn_counts(db), 1)
+
+    def __call__(self, rd):
+        journal = rd.get("journal")
+        if not isinstance(journal, str):
+            return
+
+        journal = _clean_journal(journal)
+
+        if isinstance(rd.get("issn"), str):
+            journal = self.journal_for_issn.get(_clean_issn(rd["issn"]), journal)
+
+        rd["journal"] = journal
+
+
+class PagesNormalizer(object):
+    """Write page ranges the BibTeX way, with a double hyphen: "123-130",
+    "123 - 130", and "123–130" all become "123--130"."""
+
+    name = "pages"
+
+    def __call__(self, rd):
+        pages = rd.get("pages")
+        if not isinstance(pages, str):
+            return
+
+        m = _page_range_re.match(pages)
+        if m is not None:
+            rd["pages"] = m.group(1) + "--" + m.group(2)
+
+
+# Order matters: the ISSN is used when normalizing the journal name.
+_builtin_normalizers = collections.OrderedDict(
+    [
+        ("issn", IssnNormalizer),
+        ("journal", JournalNormalizer),
+        ("pages", PagesNormalizer),
+    ]
+)
+
+
+def get_normalizer(name):
+    factory = _builtin_normalizers.get(name)
+
+    if factory is None:
+        from importlib.metadata import entry_points
+
+        for ep in entry_points(group="bibtools.normalizers", name=name):
+            factory = ep.load()
+            break
+        else:
+            die('unrecognized refdata normalizer "%s"', name)
+
+    return factory()
+
+
+def default_normalizers():
+    return [f() for f in _builtin_normalizers.values()]
+
+
+def normalize_refdata(rd, normalizers):
+    """Apply `normalizers` to the refdata dict `rd`, in place. Returns `rd`."""
+
+    for n in normalizers:
+        n(rd)
+
+    return rd
+
+
+def normalize_library(db, normalizers, dryrun=False, batchsize=1000):
+    """Run the refdata of every pub in the database through `normalizers`,
+    saving the changes unless `dryrun` is true. Records are processed in
+    batches of `batchsize`, and the changes are not committed, so that the
+    caller can make the whole thing one transaction.
+
+    Yields `(pubid, oldrd, newrd)` for every pub that changes.
+
+    """
+    for n in normalizers:
+        prepare = getattr(n, "prepare", None)
+        if prepare is not None:
+            prepare(db)
+
+    lastid = -1
+
+    while True:
+        rows = db.execute(
+            "SELECT id, refdata FROM pubs WHERE id > ? AND refdata NOT NULL "
+            "ORDER BY id LIMIT ?",
+            (lastid, batchsize),
+        ).fetchall()
+
+        if not len(rows):
+            break
+
+        lastid = rows[-1][0]
+        updates = []
+
+        for pubid, text in rows:
+            oldrd = decode_refdata(text)
+            newrd = normalize_refdata(dict(oldrd), normalizers)
+
+            if newrd != oldrd:
+                updates.append((pubid, newrd))
+                yield pubid, oldrd, newrd
+
+        if not dryrun and len(updates):
+            # Only intern the journals now, so that a dry run changes nothing.
+            rows = [
+                (
+                    encode_refdata(rd),
+                    db.intern_journal(rd.get("journal"), rd.get("issn")),
+                    pubid,
+                )
+                for pubid, rd in updates
+            ]
+            db.executemany(
+                "UPDATE pubs SET refdata = ?, journalid = ? WHERE id == ?", rows
+            )
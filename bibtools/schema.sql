@@ -1,3 +1,6 @@
+/* The original schema. Changes made since then are applied by the upgrade
+   functions in db.py, which also run when a new database is initialized. */
+
 CREATE TABLE pubs (
        id INTEGER UNIQUE PRIMARY KEY,
        abstract TEXT,
@@ -0,0 +1,205 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2014-2022 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+"""
+The `bib serve` daemon.
+
+We hold a warm BibApp -- configuration, database connection, imported modules
+-- and run commands sent to us over a Unix socket by the thin client in
+`client.py`, which also documents the wire protocol. Commands are run one at a
+time, in this process, with their standard streams redirected back to the
+client.
+
+"""
+
+import io
+import json
+import os
+import socket
+import sys
+import traceback
+
+from .client import HEADER, socket_path
+from .util import *
+
+__all__ = "serve".split()
+
+
+class _FrameWriter(io.RawIOBase):
+    """A raw binary stream that ships everything written to it back to the
+    client on a particular channel."""
+
+    def __init__(self, sock, chan, tty):
+        self._sock = sock
+        self._chan = chan
+        self._tty = tty
+
+    def writable(self):
+        return True
+
+    def isatty(self):
+        return self._tty
+
+    def write(self, b):
+        b = bytes(b)
+        if len(b):
+            self._sock.sendall(HEADER.pack(self._chan, len(b)) + b)
+        return len(b)
+
+
+def _make_text_stream(sock, chan, tty):
+    raw = _FrameWriter(sock, chan, tty)
+    return io.TextIOWrapper(
+        io.BufferedWriter(raw), encoding="utf-8", write_through=True
+    )
+
+
+def _exit_code(e, stderr):
+    """Convert a SystemExit into an exit code the way the interpreter does."""
+
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=stderr)
+    return 1
+
+
+def _reap_children():
+    # Commands like "read" fork off helper processes that we won't otherwise
+    # wait on.
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0] != 0:
+            pass
+    except ChildProcessError:
+        pass
+
+
+class BibServer(object):
+    def __init__(self, app, tool):
+        self.app = app
+        self.tool = tool
+        self._cfg_stamp = file_stamps([bibpath("bib.cfg")])
+
+    def _refresh_config(self):
+        stamp = file_stamps([bibpath("bib.cfg")])
+        if stamp != self._cfg_stamp:
+            self._cfg_stamp = stamp
+            self.app._thecfg = None
+            self.app._theproxy = None
+            if self.app._thedb is not None:
+                self.app._thedb.configure(self.app.cfg)
+
+    def handle(self, conn):
+        from . import util
+
+        req = json.loads(conn.makefile("rb").readline().decode("utf8"))
+
+        stdout = _make_text_stream(conn, b"o", req.get("tty", False))
+        stderr = _make_text_stream(conn, b"e", req.get("tty", False))
+        saved = (sys.stdout, sys.stderr, os.getcwd(), os.environ.get("COLUMNS"))
+
+        sys.stdout, sys.stderr = stdout, stderr
+        util._emit_color_codes = None
+        if req.get("columns") is not None:
+            os.environ["COLUMNS"] = str(req["columns"])
+        else:
+            os.environ.pop("COLUMNS", None)
+
+        code = 0
+
+        try:
+            if req["argv"][:1] == ["serve"]:
+                die("refusing to start a bib server from within a bib server")
+
+            os.chdir(req["cwd"])
+            self._refresh_config()
+            self.tool.invoke_with_usage(
+                list(req["argv"]),
+                tool=self.tool,
+                argv0=self.tool.cli_name,
+                app=self.app,
+            )
+        except SystemExit as e:
+            code = _exit_code(e, stderr)
+        except Exception:
+            traceback.print_exc(file=stderr)
+            code = 1
+        finally:
+            if self.app._thedb is not None:
+                if code == 0:
+                    self.app._thedb.commit()
+                else:
+                    self.app._thedb.rollback()
+
+            stdout.flush()
+            stderr.flush()
+            sys.stdout, sys.stderr = saved[:2]
+            util._emit_color_codes = None
+            os.chdir(saved[2])
+            if saved[3] is None:
+                os.environ.pop("COLUMNS", None)
+            else:
+                os.environ["COLUMNS"] = saved[3]
+            _reap_children()
+
+        conn.sendall(HEADER.pack(b"x", len(str(code))) + str(code).encode("ascii"))
+
+    def serve_forever(self, sock):
+        while True:
+            conn, _ = sock.accept()
+
+            try:
+                self.handle(conn)
+            except (OSError, ValueError) as e:
+                # The client went away or sent us garbage. Not our problem.
+                warn("dropped a bib client: %s", e)
+            finally:
+                conn.close()
+
+
+def serve(app, tool):
+    path = socket_path()
+    mkdir_p(os.path.dirname(path))
+
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        pass
+    else:
+        die('a bib server is already listening on "%s"', path)
+    finally:
+        probe.close()
+
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    # Other users on the system shouldn't be able to drive our database.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    oldmask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(oldmask)
+    sock.listen(8)
+
+    # Warm up the things that every command needs.
+    app.cfg
+    app.db
+
+    print("[Serving bib commands on %s]" % path, file=sys.stderr)
+
+    try:
+        BibServer(app, tool).serve_forever(sock)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
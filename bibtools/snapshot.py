@@ -0,0 +1,309 @@
+# -*- mode: python; coding: utf-8 -*-
+# Copyright 2014-2022 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+"""
+A columnar snapshot of the library, for computing summary statistics.
+
+Rather than looping over the database in Python for every report, we pull
+the interesting columns of the whole library into NumPy arrays in one pass:
+one element per pub, sorted by pub ID, plus the author lists as a sparse
+pub-by-author incidence matrix in CSR form (`auth_indptr` and `auth_indices`,
+as in SciPy, with authors numbered in order of their database IDs). Strings
+are interned: each pub stores an index into a table of distinct values,
+and the tables themselves are stored as a single buffer of UTF-8 plus an
+array of offsets.
+
+The snapshot is saved in the "cache" subdirectory of the data directory as
+an .npz file, tagged with the library revision that it was made from (see
+`BibDB.library_revision()`), and rebuilt when the library changes.
+
+"""
+
+import os
+
+import numpy as np
+
+from .util import *
+
+__all__ = "get_snapshot LibrarySnapshot".split()
+
+
+_format_version = 1
+
+
+class StringTable(object):
+    """A read-only sequence of strings stored as one UTF-8 buffer and an array
+    of offsets into it."""
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode("utf8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(data, offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i] : self.offsets[i + 1]].tobytes().decode("utf8")
+
+
+def _intern(values):
+    """Returns an array of codes for `values` along with a list of the distinct
+    values, in order of first appearance. None becomes the empty string."""
+
+    ids = {}
+    codes = np.fromiter(
+        (ids.setdefault(v or "", len(ids)) for v in values),
+        dtype=np.int32,
+        count=len(values),
+    )
+    return codes, list(ids)
+
+
+class LibrarySnapshot(object):
+    """Arrays describing the whole library. Per-pub arrays: `pubid`, `year`
+    (zero if unknown), `nfas` and `journal` (indices into the string tables
+    `nfas_names` and `journal_names`), and the booleans `keep`, `has_pdf`, and
+    `read`. The authors of pub `i` are `auth_indices[auth_indptr[i]:
+    auth_indptr[i+1]]`, in order, as indices into `author_ids` and
+    `author_names`. Editors aren't included."""
+
+    _arrays = (
+        "pubid year nfas journal keep has_pdf read auth_indptr auth_indices "
+        "author_ids"
+    ).split()
+    _tables = "nfas_names journal_names author_names".split()
+
+    def __init__(self, revision, arrays, tables):
+        self.revision = revision
+        self._pub_rows = None
+
+        for name in self._arrays:
+            setattr(self, name, arrays[name])
+        for name in self._tables:
+            setattr(self, name, tables[name])
+
+    @classmethod
+    def build(cls, db):
+        from .db import authtypes, histactions
+
+        revision = db.library_revision()
+        arrays = {}
+        tables = {}
+
+        rows = db.execute(
+            "SELECT id, ifnull(year, 0), nfas, ifnull(keep, 0), "
+            "  json_extract(refdata, '$.journal') FROM pubs ORDER BY id"
+        ).fetchall()
+        n = len(rows)
+
+        pubid = np.fromiter((r[0] for r in rows), dtype=np.int64, count=n)
+        arrays["pubid"] = pubid
+        arrays["year"] = np.fromiter((int(r[1]) for r in rows), dtype=np.int32, count=n)
+        arrays["keep"] = np.fromiter((bool(r[3]) for r in rows), dtype=bool, count=n)
+        arrays["nfas"], nfas_names = _intern([r[2] for r in rows])
+        arrays["journal"], journal_names = _intern([r[4] for r in rows])
+        tables["nfas_names"] = StringTable.from_strings(nfas_names)
+        tables["journal_names"] = StringTable.from_strings(journal_names)
+        del rows
+
+        def flag_pubs(query, *args):
+            ids = np.array([r[0] for r in db.execute(query, args)], dtype=np.int64)
+            return np.isin(pubid, ids)
+
+        arrays["has_pdf"] = flag_pubs("SELECT DISTINCT pubid FROM pdfs")
+        arrays["read"] = flag_pubs(
+            "SELECT DISTINCT pubid FROM history WHERE action == ?", histactions["read"]
+        )
+
+        au = np.array(
+            db.execute(
+                "SELECT pubid, authid FROM authors WHERE type == ? ORDER BY pubid, idx",
+                (authtypes["author"],),
+            ).fetchall(),
+            dtype=np.int64,
+        ).reshape((-1, 2))
+
+        # Drop any stray rows for pubs that no longer exist.
+        rowidx = np.searchsorted(pubid, au[:, 0])
+        ok = rowidx < n
+        ok[ok] = pubid[rowidx[ok]] == au[ok, 0]
+        rowidx = rowidx[ok]
+
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rowidx, minlength=n), out=indptr[1:])
+        author_ids, indices = np.unique(au[ok, 1], return_inverse=True)
+        arrays["auth_indptr"] = indptr
+        arrays["auth_indices"] = indices.astype(np.int32)
+        arrays["author_ids"] = author_ids
+        del au
+
+        names = db.get_author_names(author_ids.tolist())
+        tables["author_names"] = StringTable.from_strings(
+            [names.get(i, "") for i in author_ids.tolist()]
+        )
+
+        return cls(revision, arrays, tables)
+
+    @classmethod
+    def load(cls, path):
+        """Returns None if the file doesn't exist or is for a different version of
+        this code."""
+
+        try:
+            f = np.load(path, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+
+        with f:
+            meta = f["_meta"]
+            if meta[0] != _format_version:
+                return None
+
+            arrays = dict((name, f[name]) for name in cls._arrays)
+            tables = dict(
+                (name, StringTable(f[name + "_data"], f[name + "_offsets"]))
+                for name in cls._tables
+            )
+
+        return cls(int(meta[1]), arrays, tables)
+
+    def save(self, path):
+        contents = dict((name, getattr(self, name)) for name in self._arrays)
+
+        for name in self._tables:
+            table = getattr(self, name)
+            contents[name + "_data"] = table.data
+            contents[name + "_offsets"] = table.offsets
+
+        contents["_meta"] = np.array([_format_version, self.revision], dtype=np.int64)
+
+        # Write to a temporary file and rename it into place so that concurrent
+        # processes never see a partial file.
+        temppath = "%s.%d.tmp" % (path, os.getpid())
+
+        with open(temppath, "wb") as f:
+            np.savez(f, **contents)
+
+        os.replace(temppath, path)
+
+    # Reports
+
+    def pub_rows(self):
+        """The index of the pub in each element of `auth_indices`: the row
+        indices of the author matrix in COO form."""
+
+        if self._pub_rows is None:
+            self._pub_rows = np.repeat(
+                np.arange(len(self.pubid), dtype=np.int32), np.diff(self.auth_indptr)
+            )
+        return self._pub_rows
+
+    def author_indices_of(self, authids):
+        """Map database author IDs to our author indices, skipping ones that don't
+        appear in the snapshot."""
+
+        authids = np.asarray(authids, dtype=np.int64)
+        idx = np.searchsorted(self.author_ids, authids)
+        ok = idx < len(self.author_ids)
+        ok[ok] = self.author_ids[idx[ok]] == authids[ok]
+        return idx[ok]
+
+    def pub_indices_of(self, pubids):
+        pubids = np.asarray(pubids, dtype=np.int64)
+        idx = np.searchsorted(self.pubid, pubids)
+        ok = idx < len(self.pubid)
+        ok[ok] = self.pubid[idx[ok]] == pubids[ok]
+        return idx[ok]
+
+    def years(self):
+        """Returns arrays of the distinct known years and the number of pubs from
+        each of them."""
+        return np.unique(self.year[self.year > 0], return_counts=True)
+
+    def _top(self, counts, table, n, skip_empty=True):
+        order = np.argsort(-counts, kind="stable")
+        result = []
+
+        for i in order:
+            if counts[i] == 0 or len(result) == n:
+                break
+
+            name = table[i]
+            if skip_empty and not len(name):
+                continue
+
+            result.append((name, int(counts[i])))
+
+        return result
+
+    def top_journals(self, n=20):
+        """Returns a list of `(journal, npubs)`, most common first."""
+        counts = np.bincount(self.journal, minlength=len(self.journal_names))
+        return self._top(counts, self.journal_names, n)
+
+    def top_authors(self, n=20):
+        """Returns a list of `(encoded_name, npubs)`, most prolific first."""
+        counts = np.bincount(self.auth_indices, minlength=len(self.author_names))
+        return self._top(counts, self.author_names, n)
+
+    def top_coauthors(self, authidxs, n=20):
+        """Find the most frequent coauthors of the authors with the given indices,
+        which are assumed to be the same person. Returns the number of pubs by
+        the person and a list of `(encoded_name, npubs)`."""
+
+        rows = self.pub_rows()
+        target = np.zeros(len(self.author_names), dtype=bool)
+        target[authidxs] = True
+
+        selected = np.zeros(len(self.pubid), dtype=bool)
+        selected[rows[target[self.auth_indices]]] = True
+
+        counts = np.bincount(
+            self.auth_indices[selected[rows]], minlength=len(self.author_names)
+        )
+        counts[target] = 0
+        return int(selected.sum()), self._top(counts, self.author_names, n)
+
+    def unread(self, pubids):
+        """Returns the database IDs of those of `pubids` that have not been read."""
+        idx = self.pub_indices_of(pubids)
+        return self.pubid[idx[~self.read[idx]]]
+
+
+_memo = None
+
+
+def get_snapshot(db):
+    """Get an up-to-date snapshot of the library, loading it from the cache if
+    possible, and building and saving it if not."""
+
+    global _memo
+
+    revision = db.library_revision()
+
+    if _memo is not None and _memo.revision == revision:
+        return _memo
+
+    path = bibpath("cache", "snapshot.npz")
+    snap = LibrarySnapshot.load(path)
+
+    if snap is None or snap.revision != revision:
+        snap = LibrarySnapshot.build(db)
+
+        try:
+            mkdir_p(bibpath("cache"))
+            snap.save(path)
+        except OSError as e:
+            warn("cannot save library snapshot %s: %s", path, e)
+
+    _memo = snap
+    return snap
@@ -6,15 +6,40 @@
 Import/export from our text format.
 """
 
-import json
+import re
 
 from .util import *
 from .bibcore import *
+from .db import decode_refdata
 
 __all__ = "export_one import_one".split()
 
 
-def export_one(app, pub, stream, width, include_backup_data=False):
+_truncation_re = re.compile(r"^--(\d+) names in total(?:, including (.+))?--$")
+
+
+def _write_truncation(write, truncation):
+    # Marks a name list that was truncated by the "max-authors" setting.
+    if truncation is None:
+        return
+
+    total, collab = truncation
+    write("--%d names in total" % total)
+    if collab is not None:
+        write(", including ")
+        write(collab)
+    write("--\n")
+
+
+def export_one(app, pub, stream, width, include_backup_data=False, batch=None):
+    """If `batch` is given, it should be a PubBatch containing `pub`, loaded
+    with backup data if `include_backup_data` is true. The pub's other
+    information is then taken from it rather than queried one pub at a
+    time."""
+
+    if batch is None:
+        batch = app.db.load_pub_batch([pub], backup=include_backup_data)
+
     write = stream.write
 
     # Title and year
@@ -39,37 +64,38 @@ def export_one(app, pub, stream, width, include_backup_data=False):
     write("doi = ")
     write(pub.doi or "")
     write("\n")
-    for (nick,) in app.db.execute(
-        "SELECT nickname FROM nicknames WHERE pubid == ? " "ORDER BY nickname asc",
-        (pub.id,),
-    ):
+    for nick in sorted(batch.nicknames.get(pub.id, ())):
         write("nick = ")
         write(nick)
         write("\n")
     write("\n")
 
     # Authors
+    truncated = batch.truncated.get(pub.id, {})
+    authors, editors = batch.names.get(pub.id, ((), ()))
     anyauth = False
-    for given, family in app.db.get_pub_authors(pub.id, "author"):
+    for given, family in parse_names(authors):
         write(encode_name(given, family))
         write("\n")
         anyauth = True
     if not anyauth:
         write("--no authors--\n")
+    _write_truncation(write, truncated.get("author"))
     firsteditor = True
-    for given, family in app.db.get_pub_authors(pub.id, "editor"):
+    for given, family in parse_names(editors):
         if firsteditor:
             write("--editors--\n")
             firsteditor = False
         write(encode_name(given, family))
         write("\n")
+    _write_truncation(write, truncated.get("editor"))
     write("\n")
 
     # Reference info
     if pub.refdata is None:
         write("--no reference data--\n")
     else:
-        rd = json.loads(pub.refdata)
+        rd = decode_refdata(pub.refdata)
 
         btype = rd.pop("_type")
         write("@")
@@ -91,16 +117,12 @@ def export_one(app, pub, stream, width, include_backup_data=False):
 
         write("@backup_data\n")
 
-        for (sha1,) in app.db.execute(
-            "SELECT sha1 FROM pdfs WHERE pubid == ?", (pub.id,)
-        ):
+        for sha1 in batch.pdfs.get(pub.id, ()):
             write("pdfsha1 = ")
             write(sha1)
             write("\n")
 
-        for name, idx in app.db.execute(
-            "SELECT name, idx FROM publists WHERE pubid == ?", (pub.id,)
-        ):
+        for name, idx in batch.lists.get(pub.id, ()):
             b64name = b64encode(name.encode("utf8")).decode("ascii")
             write("inlist = b64name:%s index:%d\n" % (b64name, idx))
 
@@ -181,13 +203,19 @@ def import_one(stream):
     # authors
     c = _import_get_chunk(stream)
     namelist = info["authors"] = []
+    authtype = "author"
 
     for line in c:
+        m = _truncation_re.match(line)
+
         # This "--" flag must be exact for --editors-- to work
         if line == "--no authors--":
             pass
         elif line == "--editors--":
             namelist = info["editors"] = []
+            authtype = "editor"
+        elif m is not None:
+            info.setdefault("truncated", {})[authtype] = [int(m.group(1)), m.group(2)]
         else:
             namelist.append(line)
 
@@ -13,6 +13,9 @@ unicode_to_latex_string returns a Unicode string rather than bytes. That is,
 
 """
 
+import functools
+import re
+
 # Based on https://gist.github.com/798549 (owned by github user piquadrat),
 # but modified to make a table usable with unicode.translate(). I had to
 # comment out a few things and also tweak various of the conversions to make
@@ -2391,5 +2394,28 @@ unicode_to_latex_table_base = {
 unicode_to_latex_table = dict(
     (ord(k), str(v)) for k, v in unicode_to_latex_table_base.items()
 )
-unicode_to_latex_string = lambda u: u.translate(unicode_to_latex_table)
-unicode_to_latex = lambda u: u.translate(unicode_to_latex_table).encode("ascii")
+
+# Most strings that we see (page numbers, volumes, ISSNs, lots of names) are
+# ASCII without any of the few ASCII characters that the table touches, and
+# don't need to go through translate() at all.
+
+_ascii_needing_translation = re.compile(
+    "[%s]" % re.escape("".join(chr(c) for c in unicode_to_latex_table if c < 128))
+)
+
+
+def unicode_to_latex_string(u):
+    if u.isascii() and _ascii_needing_translation.search(u) is None:
+        return u
+    return u.translate(unicode_to_latex_table)
+
+
+# Journal names and frequent authors come up over and over again in a big
+# bibliography, so we also remember recent results.
+
+
+@functools.lru_cache(maxsize=8192)
+def unicode_to_latex(u):
+    if u.isascii() and _ascii_needing_translation.search(u) is None:
+        return u.encode("ascii")
+    return u.translate(unicode_to_latex_table).encode("ascii")
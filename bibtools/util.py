@@ -15,7 +15,9 @@ import sys
 
 # Generic things
 
-__all__ = ("die warn reraise_context squish_spaces mkdir_p").split()
+__all__ = (
+    "die warn reraise_context squish_spaces mkdir_p file_stamps default_file_mode"
+).split()
 
 
 def die(fmt, *args):
@@ -64,6 +66,33 @@ def mkdir_p(path):
             raise
 
 
+def file_stamps(paths):
+    """Returns a list of `(path, mtime_ns, size)` for each of `paths`, for
+    checking whether any of the files have changed. The mtime and size of a
+    file that doesn't exist are None."""
+
+    stamps = []
+
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stamps.append((path, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            stamps.append((path, None, None))
+
+    return stamps
+
+
+def default_file_mode():
+    """The permissions that a newly created file would get under the current
+    umask. Handy for files made by mkstemp() and friends, which only their
+    owner can read."""
+
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
 # More app-specific
 
 __all__ += (
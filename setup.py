@@ -18,13 +18,14 @@ setup(
     zip_safe=False,
     packages=["bibtools", "bibtools.hacked_bibtexparser"],
     install_requires=[
+        "numpy",
         "pwkit >= 0.8.0",
     ],
     package_data={
         "bibtools": ["*.sql", "apj-issnmap.txt", "defaults.cfg"],
     },
     entry_points={
-        "console_scripts": ["bib = bibtools.cli:commandline"],
+        "console_scripts": ["bib = bibtools.client:commandline"],
     },
     author="Peter Williams",
     author_email="peter@newton.cx",
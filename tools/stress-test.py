@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+# Copyright 2014-2022 Peter Williams <peter@newton.cx>
+# Licensed under the GNU General Public License, version 3 or higher.
+
+"""Run many bib processes at once against a scratch database.
+
+usage: stress-test.py [nprocs] [rounds]
+
+This is for checking that concurrent bib processes wait for each other rather
+than failing with "database is locked". A throwaway database is set up in a
+temporary directory, so your own library isn't touched. Each of "nprocs"
+workers (default 8) runs "rounds" rounds (default 10) of ingest, btexport,
+canon-journal, and info commands. The bibtools package must be importable.
+
+"""
+
+import io
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+
+
+def main(argv):
+    if len(argv) > 3:
+        print(__doc__.strip(), file=sys.stderr)
+        return 1
+
+    nprocs = int(argv[1]) if len(argv) > 1 else 8
+    rounds = int(argv[2]) if len(argv) > 2 else 10
+
+    work = tempfile.mkdtemp(prefix="bib.stress.")
+    env = dict(os.environ, XDG_DATA_HOME=work, BIBTOOLS_NO_SERVER="1")
+    bib = [sys.executable, "-c", "from bibtools.cli import commandline; commandline()"]
+    failures = []
+
+    def run(*args):
+        p = subprocess.run(bib + list(args), env=env, cwd=work, capture_output=True)
+        if p.returncode != 0:
+            err = p.stderr.decode("utf8", "replace").strip().splitlines()
+            failures.append((args, err[-1] if len(err) else "(no message)"))
+
+    def worker(k):
+        for r in range(rounds):
+            nick = "w%dr%d" % (k, r)
+
+            with io.open(os.path.join(work, nick + ".bib"), "wt") as f:
+                print(
+                    "@article{%s,\n author = {Worker%d, A. and Round%d, B.},\n"
+                    " title = {Stress %s},\n journal = {Journal %d},\n"
+                    " year = {2000},\n pages = {%d-%d}\n}"
+                    % (nick, k, r, nick, k, r, r + 1),
+                    file=f,
+                )
+
+            with io.open(os.path.join(work, nick + ".aux"), "wt") as f:
+                for j in range(r + 1):
+                    print("\\citation{w%dr%d}" % (k, j), file=f)
+
+            run("ingest", nick + ".bib")
+            run("btexport", "apj", nick + ".aux")
+            run("canon-journal", "Journal %d" % k, "Journal %d" % k)
+            run("info", nick)
+
+    try:
+        run("init")
+        if failures:
+            print(
+                "error: could not set up the scratch database: %s" % failures[0][1],
+                file=sys.stderr,
+            )
+            return 1
+
+        threads = [threading.Thread(target=worker, args=(k,)) for k in range(nprocs)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        with sqlite3.connect(os.path.join(work, "bib", "db.sqlite3")) as sdb:
+            npubs = sdb.execute("SELECT count(*) FROM pubs").fetchone()[0]
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    for args, err in failures:
+        print("failed: bib %s: %s" % (" ".join(args), err))
+
+    print(
+        "%d commands failed; %d of %d publications made it in"
+        % (len(failures), npubs, nprocs * rounds)
+    )
+
+    if failures or npubs != nprocs * rounds:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))